@@ -3,6 +3,10 @@ QEMU accel module:
 
 This module provides utilities for discover and check the availability of
 accelerators.
+
+Probe results are cached per QEMU binary, keyed by its path, size and
+modification time, both in memory and in a JSON file shared between
+processes (see probe_cache_file()).
 """
 # Copyright (C) 2015-2016 Red Hat Inc.
 # Copyright (C) 2012 IBM Corp.
@@ -14,9 +18,15 @@ accelerators.
 # the COPYING file in the top-level directory.
 #
 
+import json
 import logging
 import os
+import shutil
 import subprocess
+import tempfile
+from typing import Dict, List, Tuple
+
+from .machine import QEMUMachine, MonitorResponseError
 
 LOG = logging.getLogger(__name__)
 
@@ -28,17 +38,110 @@ ADDITIONAL_ARCHES = {
     "ppc64le": "ppc64",
 }
 
+# Probe results by (path, size, mtime_ns) of the QEMU binary
+_PROBE_CACHE: Dict[Tuple[str, int, int], Dict[str, List[str]]] = {}
 
-def list_accel(qemu_bin):
+
+def probe_cache_file():
     """
-    List accelerators enabled in the QEMU binary.
+    Return the path of the on-disk probe cache, or None if disabled.
 
-    @param qemu_bin (str): path to the QEMU binary.
-    @raise Exception: if failed to run `qemu -accel help`
-    @return a list of accelerator names.
+    The location can be set with the QEMU_PROBE_CACHE environment
+    variable; setting it to an empty string disables the on-disk cache.
     """
-    if not qemu_bin:
-        return []
+    path = os.environ.get('QEMU_PROBE_CACHE')
+    if path is not None:
+        return path or None
+    cache_dir = os.environ.get('XDG_CACHE_HOME',
+                               os.path.join(os.path.expanduser('~'),
+                                            '.cache'))
+    return os.path.join(cache_dir, 'qemu', 'probe-cache.json')
+
+
+def clear_probe_cache():
+    """
+    Forget all cached probe results, including the on-disk ones.
+    """
+    _PROBE_CACHE.clear()
+    path = probe_cache_file()
+    if path:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def _binary_key(qemu_bin):
+    path = shutil.which(qemu_bin) or qemu_bin
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def _load_probe_file():
+    path = probe_cache_file()
+    if not path:
+        return {}
+    try:
+        with open(path, encoding='utf-8') as cache:
+            return json.load(cache)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_probe_file(key, probes):
+    path = probe_cache_file()
+    if not path:
+        return
+    data = _load_probe_file()
+    data[key[0]] = {'size': key[1], 'mtime_ns': key[2], 'probes': probes}
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    except OSError:
+        LOG.debug("Failed to write probe cache %s", path, exc_info=True)
+        return
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as cache:
+            json.dump(data, cache)
+        os.replace(tmp, path)
+    except OSError:
+        LOG.debug("Failed to write probe cache %s", path, exc_info=True)
+    finally:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            # already moved into place
+            pass
+
+
+def _cached_probe(qemu_bin, name, probe):
+    """
+    Return the cached result called name for qemu_bin, running
+    probe(qemu_bin) to fill in the cache if needed.  probe returns a
+    dict of results, possibly including more than the one requested.
+    """
+    key = _binary_key(qemu_bin)
+    if key is None:
+        return probe(qemu_bin)[name]
+    probes = _PROBE_CACHE.get(key)
+    if probes is None:
+        entry = _load_probe_file().get(key[0])
+        if (entry and entry.get('size') == key[1] and
+                entry.get('mtime_ns') == key[2]):
+            probes = entry['probes']
+        else:
+            probes = {}
+        _PROBE_CACHE[key] = probes
+    if name not in probes:
+        probes.update(probe(qemu_bin))
+        _save_probe_file(key, probes)
+    return list(probes[name])
+
+
+def _probe_accel(qemu_bin):
     try:
         out = subprocess.check_output([qemu_bin, '-accel', 'help'],
                                       universal_newlines=True)
@@ -46,7 +149,74 @@ def list_accel(qemu_bin):
         LOG.debug("Failed to get the list of accelerators in %s", qemu_bin)
         raise
     # Skip the first line which is the header.
-    return [acc.strip() for acc in out.splitlines()[1:]]
+    return {'accel': [acc.strip() for acc in out.splitlines()[1:]]}
+
+
+def _probe_qmp(qemu_bin):
+    """
+    Query machine types, CPU models and device types from a single
+    QEMU instance.
+    """
+    name = "qemu-probe-%d" % os.getpid()
+    with QEMUMachine(qemu_bin, name=name,
+                     test_dir=tempfile.gettempdir()) as vm:
+        vm.set_machine('none')
+        vm.add_args('-nodefaults')
+        vm.launch()
+        machines = [m['name'] for m in vm.command('query-machines')]
+        try:
+            cpus = [c['name'] for c in vm.command('query-cpu-definitions')]
+        except MonitorResponseError:
+            # Not all targets implement query-cpu-definitions
+            cpus = []
+        devices = [t['name'] for t in vm.command('qom-list-types',
+                                                 implements='device',
+                                                 abstract=False)]
+    return {'machines': machines, 'cpus': cpus, 'devices': devices}
+
+
+def list_accel(qemu_bin):
+    """
+    List accelerators enabled in the QEMU binary.
+
+    @param qemu_bin (str): path to the QEMU binary.
+    @raise Exception: if failed to run `qemu -accel help`
+    @return a list of accelerator names.
+    """
+    if not qemu_bin:
+        return []
+    return _cached_probe(qemu_bin, 'accel', _probe_accel)
+
+
+def list_machines(qemu_bin):
+    """
+    List machine types supported by the QEMU binary.
+
+    @param qemu_bin (str): path to the QEMU binary.
+    @return a list of machine type names.
+    """
+    return _cached_probe(qemu_bin, 'machines', _probe_qmp)
+
+
+def list_cpu_models(qemu_bin):
+    """
+    List CPU models supported by the QEMU binary.
+
+    @param qemu_bin (str): path to the QEMU binary.
+    @return a list of CPU model names, empty if the target does not
+            report them.
+    """
+    return _cached_probe(qemu_bin, 'cpus', _probe_qmp)
+
+
+def list_devices(qemu_bin):
+    """
+    List non-abstract device types available in the QEMU binary.
+
+    @param qemu_bin (str): path to the QEMU binary.
+    @return a list of device type names.
+    """
+    return _cached_probe(qemu_bin, 'devices', _probe_qmp)
 
 
 def kvm_available(target_arch=None, qemu_bin=None):
@@ -0,0 +1,619 @@
+"""
+QEMU Monitor Protocol asyncio client
+
+The AsyncQEMUMonitorProtocol class talks QMP over an asyncio stream, so that
+one event loop can drive the monitors of many VMs.  Commands are tagged with
+unique ids and may be in flight concurrently; replies are matched to their
+command by id.  Events are delivered through a bounded queue.
+
+The SyncQEMUMonitorProtocol class provides the blocking API of
+qmp.QEMUMonitorProtocol on top of it, running a private event loop.
+qmp.QEMUMonitorProtocol itself stays a plain socket client: it also
+talks to the guest agent, which sends no greeting, and scripts subclass it.
+"""
+
+# This work is licensed under the terms of the GNU GPL, version 2.  See
+# the COPYING file in the top-level directory.
+
+import asyncio
+import itertools
+import json
+import logging
+import select
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Set,
+)
+
+from .qmp import (
+    QMPCapabilitiesError,
+    QMPConnectError,
+    QMPError,
+    QMPProtocolError,
+    QMPTimeoutError,
+)
+
+
+# Largest QMP message accepted, query-qmp-schema replies are several MiB
+STREAM_LIMIT = 64 * 1024 * 1024
+
+
+class AsyncQEMUMonitorProtocol:
+    """
+    Connect to QEMU via QEMU Monitor Protocol (QMP) using asyncio.
+
+    Events are queued as they are read.  When the queue holds `max_events`
+    events, reading from the monitor pauses until events are consumed, which
+    in turn makes QEMU stop writing to the socket.  Replies to commands are
+    read from the same stream, so clients that bound the queue must keep
+    consuming events while they wait for command replies.
+    """
+
+    #: Logger object for debugging messages
+    logger = logging.getLogger('QMP')
+
+    def __init__(self, address, server=False, nickname=None, max_events=0):
+        """
+        Create an AsyncQEMUMonitorProtocol object.
+
+        @param address: QEMU address, can be either a unix socket path (string)
+                        or a tuple in the form ( address, port ) for a TCP
+                        connection
+        @param server: server mode listens on the socket (bool)
+        @param nickname: name used for the logger (string)
+        @param max_events: size of the event queue, 0 for unbounded
+        @note No connection is established, this is done by the connect() or
+              accept() coroutines
+        """
+        self._address = address
+        self._server = server
+        self._max_events = max_events
+        self._nickname = nickname
+        if self._nickname:
+            self.logger = logging.getLogger('QMP').getChild(self._nickname)
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._listener = None
+        self._accepted: Optional[asyncio.Future] = None
+        self._pending: Dict[str, asyncio.Future] = {}
+        # ids of commands that timed out or were cancelled; their replies
+        # may still arrive and are dropped
+        self._abandoned: Set[str] = set()
+        self._ids = itertools.count()
+        self._events: Optional[asyncio.Queue] = None
+        self.greeting: Optional[Dict[str, Any]] = None
+
+    def _event_queue(self) -> asyncio.Queue:
+        # Created lazily so that it binds to the loop running the client
+        if self._events is None:
+            self._events = asyncio.Queue(self._max_events)
+        return self._events
+
+    @property
+    def connected(self) -> bool:
+        """True if a connection to the monitor is established."""
+        return self._reader_task is not None and not self._reader_task.done()
+
+    async def listen(self) -> None:
+        """
+        Bind and listen on the socket in server mode, before QEMU connects.
+
+        @raise OSError on socket errors
+        """
+        if self._listener is not None:
+            return
+        loop = asyncio.get_event_loop()
+        self._accepted = loop.create_future()
+
+        def client_connected(reader, writer):
+            if self._accepted.done():
+                writer.close()
+            else:
+                self._accepted.set_result((reader, writer))
+
+        if isinstance(self._address, tuple):
+            self._listener = await asyncio.start_server(
+                client_connected, self._address[0], self._address[1],
+                limit=STREAM_LIMIT, reuse_address=True)
+        else:
+            self._listener = await asyncio.start_unix_server(
+                client_connected, self._address, limit=STREAM_LIMIT)
+
+    async def _negotiate(self, negotiate: bool) -> Optional[Dict[str, Any]]:
+        assert self._reader is not None
+        line = await self._reader.readline()
+        try:
+            greeting = json.loads(line) if line else None
+        except ValueError:
+            greeting = None
+        if not isinstance(greeting, dict) or "QMP" not in greeting:
+            await self.close()
+            raise QMPConnectError
+        self.greeting = greeting
+        self._event_queue()
+        self._reader_task = asyncio.ensure_future(self._read_loop())
+        if not negotiate:
+            return None
+        resp = await self.cmd('qmp_capabilities')
+        if resp and "return" in resp:
+            return greeting
+        raise QMPCapabilitiesError
+
+    async def connect(self, negotiate=True) -> Optional[Dict[str, Any]]:
+        """
+        Connect to the QMP Monitor and perform capabilities negotiation.
+
+        @return QMP greeting dict, or None if negotiate is false
+        @raise OSError on socket connection errors
+        @raise QMPConnectError if the greeting is not received
+        @raise QMPCapabilitiesError if fails to negotiate capabilities
+        """
+        if isinstance(self._address, tuple):
+            self._reader, self._writer = await asyncio.open_connection(
+                self._address[0], self._address[1], limit=STREAM_LIMIT)
+        else:
+            self._reader, self._writer = await asyncio.open_unix_connection(
+                self._address, limit=STREAM_LIMIT)
+        return await self._negotiate(negotiate)
+
+    async def accept(self, timeout=15.0, negotiate=True):
+        """
+        Await connection from QMP Monitor and perform capabilities negotiation.
+
+        @param timeout: timeout in seconds, or None
+        @return QMP greeting dict, or None if negotiate is false
+        @raise QMPTimeoutError if QEMU does not connect in time
+        @raise QMPConnectError if the greeting is not received
+        @raise QMPCapabilitiesError if fails to negotiate capabilities
+        """
+        await self.listen()
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.shield(self._accepted), timeout)
+        except asyncio.TimeoutError:
+            raise QMPTimeoutError("Timeout waiting for QMP connection")
+        # Allow a new connection for reconnect()
+        self._accepted = asyncio.get_event_loop().create_future()
+        return await self._negotiate(negotiate)
+
+    async def reconnect(self, negotiate=True, retries=10, delay=1.0,
+                        timeout=15.0):
+        """
+        Drop the current connection and establish a new one.
+
+        In client mode the connection is retried up to `retries` times,
+        `delay` seconds apart; in server mode the monitor is awaited for up
+        to `timeout` seconds.  Commands in flight fail with QMPConnectError,
+        queued events are kept.
+
+        @return QMP greeting dict, or None if negotiate is false
+        """
+        await self._disconnect()
+        if self._server:
+            return await self.accept(timeout, negotiate)
+        for attempt in range(retries + 1):
+            try:
+                return await self.connect(negotiate)
+            except OSError:
+                if attempt == retries:
+                    raise
+                await asyncio.sleep(delay)
+        return None
+
+    async def _read_loop(self) -> None:
+        assert self._reader is not None and self._events is not None
+        try:
+            while True:
+                data = await self._reader.readline()
+                if not data:
+                    break
+                resp = json.loads(data)
+                if 'event' in resp:
+                    self.logger.debug("<<< %s", resp)
+                    await self._events.put(resp)
+                    continue
+                self.logger.debug("<<< %s", resp)
+                resp_id = resp.get('id')
+                future = None
+                if isinstance(resp_id, str):
+                    if resp_id in self._abandoned:
+                        self._abandoned.discard(resp_id)
+                        self.logger.debug("Dropping late QMP reply: %s",
+                                          resp)
+                        continue
+                    future = self._pending.pop(resp_id, None)
+                if future is None:
+                    # The command it belongs to cannot be told, e.g. QEMU
+                    # drops the id of a command it cannot parse
+                    self.logger.warning("Unexpected QMP reply: %s", resp)
+                    self._fail_pending(
+                        QMPProtocolError("Unexpected QMP reply: %s" % resp))
+                elif not future.done():
+                    future.set_result(resp)
+        except (OSError, ValueError) as err:
+            self.logger.debug("QMP connection failed: %s", err)
+        finally:
+            self._fail_pending()
+
+    def _fail_pending(self, error: Optional[QMPError] = None) -> None:
+        if error is None:
+            error = QMPConnectError("Connection to the monitor was closed")
+        else:
+            # The connection stays up, replies to these may still arrive
+            self._abandoned.update(self._pending)
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    async def cmd_obj(self, qmp_cmd: Dict[str, Any],
+                      timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Send a QMP command to the QMP Monitor and wait for its reply.
+
+        Any number of commands may be in flight.  The command is tagged with
+        a unique id to match its reply; an 'id' given in qmp_cmd is restored
+        in the reply.
+
+        @param qmp_cmd: QMP command to be sent as a Python dict
+        @param timeout: seconds to wait for the reply, or None
+        @return QMP response as a Python dict
+        @raise QMPConnectError if the connection is or gets closed
+        @raise QMPTimeoutError if the reply does not arrive in time
+        @raise QMPProtocolError if a reply matching no command in flight
+               arrives while waiting
+        """
+        if not self.connected:
+            raise QMPConnectError("Not connected to the monitor")
+        cmd_id = '__aqmp#%d' % next(self._ids)
+        wire_cmd = dict(qmp_cmd)
+        wire_cmd['id'] = cmd_id
+        future = asyncio.get_event_loop().create_future()
+        self._pending[cmd_id] = future
+        self.logger.debug(">>> %s", qmp_cmd)
+        assert self._writer is not None
+        try:
+            self._writer.write(json.dumps(wire_cmd).encode('utf-8'))
+            await self._writer.drain()
+            resp = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise QMPTimeoutError("Timeout waiting for reply to %s" %
+                                  qmp_cmd.get('execute'))
+        except OSError as err:
+            raise QMPConnectError("Error while writing to socket: %s" % err)
+        finally:
+            # Still pending if no reply came, e.g. on timeout or when the
+            # caller was cancelled
+            if self._pending.pop(cmd_id, None) is not None:
+                self._abandoned.add(cmd_id)
+        if 'id' in qmp_cmd:
+            resp['id'] = qmp_cmd['id']
+        else:
+            del resp['id']
+        return resp
+
+    async def cmd_batch(self, qmp_cmds: List[Dict[str, Any]],
+                        window: Optional[int] = None,
+                        timeout: Optional[float] = None
+                        ) -> List[Dict[str, Any]]:
+        """
+        Send several QMP commands concurrently, see cmd_obj().
+
+        @param qmp_cmds: list of QMP commands to be sent as Python dicts
+        @param window: maximum number of commands in flight, or None
+        @param timeout: seconds to wait for each reply, or None
+        @return list of QMP responses in the order of qmp_cmds
+        """
+        if window is None:
+            return await asyncio.gather(*[self.cmd_obj(qmp_cmd, timeout)
+                                          for qmp_cmd in qmp_cmds])
+        slots = asyncio.Semaphore(window)
+
+        async def _cmd(qmp_cmd):
+            async with slots:
+                return await self.cmd_obj(qmp_cmd, timeout)
+        return await asyncio.gather(*[_cmd(qmp_cmd) for qmp_cmd in qmp_cmds])
+
+    async def cmd(self, name, args=None, cmd_id=None, timeout=None):
+        """
+        Build a QMP command and send it to the QMP Monitor.
+
+        @param name: command name (string)
+        @param args: command arguments (dict)
+        @param cmd_id: command id (dict, list, string or int)
+        @param timeout: seconds to wait for the reply, or None
+        """
+        qmp_cmd = {'execute': name}
+        if args:
+            qmp_cmd['arguments'] = args
+        if cmd_id:
+            qmp_cmd['id'] = cmd_id
+        return await self.cmd_obj(qmp_cmd, timeout)
+
+    async def command(self, cmd, **kwds):
+        """
+        Build and send a QMP command to the monitor, report errors if any
+        """
+        ret = await self.cmd(cmd, kwds)
+        if "error" in ret:
+            raise QMPError(ret['error']['desc'])
+        return ret['return']
+
+    async def get_event(self, timeout: Optional[float] = None
+                        ) -> Dict[str, Any]:
+        """
+        Wait for the next QMP event.
+
+        @param timeout: seconds to wait, or None
+        @raise QMPTimeoutError if no event arrives in time
+        """
+        try:
+            return await asyncio.wait_for(self._event_queue().get(), timeout)
+        except asyncio.TimeoutError:
+            raise QMPTimeoutError("Timeout waiting for event")
+
+    def get_events_nowait(self) -> List[Dict[str, Any]]:
+        """
+        Return (and remove) all QMP events queued so far.
+        """
+        events = []
+        queue = self._event_queue()
+        while not queue.empty():
+            events.append(queue.get_nowait())
+        return events
+
+    async def events(self):
+        """
+        Asynchronous iterator over QMP events.
+
+        Iteration ends once the connection is closed and all queued events
+        have been consumed.
+        """
+        queue = self._event_queue()
+        while True:
+            if queue.empty():
+                if not self.connected:
+                    return
+                get = asyncio.ensure_future(queue.get())
+                await asyncio.wait([get, self._reader_task],
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if not get.done():
+                    get.cancel()
+                    continue
+                yield get.result()
+            else:
+                yield queue.get_nowait()
+
+    async def _disconnect(self) -> None:
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+            self._reader_task = None
+        self._fail_pending()
+        self._abandoned.clear()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._reader = None
+
+    async def close(self) -> None:
+        """
+        Close the connection and, in server mode, the listening socket.
+        """
+        await self._disconnect()
+        if self._listener is not None:
+            self._listener.close()
+            await self._listener.wait_closed()
+            self._listener = None
+
+    def get_sock_fd(self) -> int:
+        """
+        Get the file descriptor of the connected socket.
+        """
+        assert self._writer is not None
+        return self._writer.get_extra_info('socket').fileno()
+
+    def is_scm_available(self) -> bool:
+        """
+        Check if the socket allows for SCM_RIGHTS.
+        """
+        return not isinstance(self._address, tuple)
+
+
+class SyncQEMUMonitorProtocol:
+    """
+    Blocking wrapper around AsyncQEMUMonitorProtocol, with the API of
+    qmp.QEMUMonitorProtocol.
+
+    The wrapper owns a private event loop, which only runs during calls.
+    Events that arrived in between are picked up by the next call.
+    """
+
+    def __init__(self, address, server=False, nickname=None):
+        """
+        Create a SyncQEMUMonitorProtocol object.
+
+        @param address: QEMU address, can be either a unix socket path (string)
+                        or a tuple in the form ( address, port ) for a TCP
+                        connection
+        @param server: server mode listens on the socket (bool)
+        @raise OSError on socket connection errors
+        """
+        self._loop = asyncio.new_event_loop()
+        self._qmp = AsyncQEMUMonitorProtocol(address, server, nickname)
+        self._events: List[Dict[str, Any]] = []
+        self._timeout: Optional[float] = None
+        if server:
+            self._run(self._qmp.listen())
+
+    @property
+    def async_protocol(self) -> AsyncQEMUMonitorProtocol:
+        """The underlying AsyncQEMUMonitorProtocol object."""
+        return self._qmp
+
+    def _run(self, coro):
+        return self._loop.run_until_complete(coro)
+
+    def _poll(self) -> None:
+        async def _drain(fd):
+            # Each loop iteration polls the socket, and the reader task
+            # parses what was read in the next one.  Once the socket had
+            # nothing to read for a whole iteration, everything that had
+            # arrived has been consumed.
+            idle = 0
+            while idle < 2:
+                readable, _, _ = select.select([fd], [], [], 0)
+                idle = 0 if readable else idle + 1
+                await asyncio.sleep(0)
+        if self._qmp.connected:
+            self._run(_drain(self._qmp.get_sock_fd()))
+        self._events.extend(self._qmp.get_events_nowait())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def connect(self, negotiate=True):
+        """
+        Connect to the QMP Monitor and perform capabilities negotiation.
+
+        @return QMP greeting dict, or None if negotiate is false
+        """
+        return self._run(self._qmp.connect(negotiate))
+
+    def accept(self, timeout=15.0):
+        """
+        Await connection from QMP Monitor and perform capabilities negotiation.
+
+        @return QMP greeting dict
+        """
+        return self._run(self._qmp.accept(timeout))
+
+    def cmd_obj(self, qmp_cmd):
+        """
+        Send a QMP command to the QMP Monitor.
+
+        @return QMP response as a Python dict or None if the connection has
+                been closed
+        """
+        try:
+            return self._run(self._qmp.cmd_obj(qmp_cmd, self._timeout))
+        except QMPConnectError:
+            return None
+        finally:
+            self._events.extend(self._qmp.get_events_nowait())
+
+    def cmd_batch(self, qmp_cmds, window=None):
+        """
+        Send several QMP commands without waiting for each reply.
+
+        @return list of QMP responses in the order of qmp_cmds, or None if
+                the connection has been closed
+        """
+        try:
+            return self._run(self._qmp.cmd_batch(qmp_cmds, window,
+                                                 self._timeout))
+        except QMPConnectError:
+            return None
+        finally:
+            self._events.extend(self._qmp.get_events_nowait())
+
+    def cmd(self, name, args=None, cmd_id=None):
+        """
+        Build a QMP command and send it to the QMP Monitor.
+        """
+        qmp_cmd = {'execute': name}
+        if args:
+            qmp_cmd['arguments'] = args
+        if cmd_id:
+            qmp_cmd['id'] = cmd_id
+        return self.cmd_obj(qmp_cmd)
+
+    def command(self, cmd, **kwds):
+        """
+        Build and send a QMP command to the monitor, report errors if any
+        """
+        ret = self.cmd(cmd, kwds)
+        if "error" in ret:
+            raise Exception(ret['error']['desc'])
+        return ret['return']
+
+    def _get_events(self, wait=False):
+        self._poll()
+        if self._events or not wait:
+            return
+        if not self._qmp.connected:
+            raise QMPConnectError("Error while reading from socket")
+        timeout = wait if isinstance(wait, float) else None
+        self._events.append(self._run(self._qmp.get_event(timeout)))
+
+    def pull_event(self, wait=False):
+        """
+        Pulls a single event.
+
+        @param wait (bool): block until an event is available.
+        @param wait (float): If wait is a float, treat it as a timeout value.
+
+        @raise QMPTimeoutError: If a timeout float is provided and the timeout
+                                period elapses.
+        @raise QMPConnectError: If wait is True but no events could be
+                                retrieved.
+
+        @return The first available QMP event, or None.
+        """
+        self._get_events(wait)
+        if self._events:
+            return self._events.pop(0)
+        return None
+
+    def get_events(self, wait=False):
+        """
+        Get a list of available QMP events.
+
+        @return The list of available QMP events.
+        """
+        self._get_events(wait)
+        return self._events
+
+    def clear_events(self):
+        """
+        Clear current list of pending events.
+        """
+        self._events = []
+
+    def close(self):
+        """
+        Close the connection and the private event loop.
+        """
+        if not self._loop.is_closed():
+            self._run(self._qmp.close())
+            self._loop.close()
+
+    def settimeout(self, timeout):
+        """
+        Set the timeout for command replies.
+
+        @param timeout (float): timeout in seconds, or None.
+        """
+        self._timeout = timeout
+
+    def get_sock_fd(self):
+        """
+        Get the socket file descriptor.
+        """
+        return self._qmp.get_sock_fd()
+
+    def is_scm_available(self):
+        """
+        Check if the socket allows for SCM_RIGHTS.
+        """
+        return self._qmp.is_scm_available()
@@ -0,0 +1,178 @@
+"""
+QEMU machine fleet module:
+
+The fleet module provides the QEMUMachineFleet class, which launches,
+queries and shuts down a group of QEMU VMs concurrently.
+"""
+
+# This work is licensed under the terms of the GNU GPL, version 2.  See
+# the COPYING file in the top-level directory.
+#
+
+from collections import namedtuple
+import concurrent.futures
+import logging
+import os
+import signal
+from typing import Optional, Type
+from types import TracebackType
+
+from .machine import QEMUMachineError
+
+LOG = logging.getLogger(__name__)
+
+
+FleetResult = namedtuple('FleetResult', ['machine', 'value', 'error'])
+FleetResult.__doc__ = """
+Outcome of a fleet operation on one machine: the value returned for it, or
+the exception raised (value is then None).
+"""
+
+
+class QEMUMachineFleet:
+    """
+    A group of QEMU VMs operated on concurrently
+
+    Each operation runs on all machines in parallel, waits for them up to
+    an optional timeout shared by the whole fleet, and returns a list of
+    FleetResult in the order the machines were given.  Machines that did
+    not finish in time get a QEMUMachineError; their operation keeps
+    running in the background.  The next operation on such a machine,
+    including shutdown(), cancels it if it has not started yet and waits
+    for it otherwise, so operations on one machine never overlap.  Use
+    this object as a context manager to ensure all QEMU processes
+    terminate::
+
+        with QEMUMachineFleet([QEMUMachine(binary, name='vm%d' % i)
+                               for i in range(16)]) as fleet:
+            fleet.launch(timeout=30)
+            for res in fleet.command('query-status'):
+                ...
+    """
+
+    def __init__(self, machines, max_workers=None):
+        '''
+        Initialize a QEMUMachineFleet
+
+        @param machines: the QEMUMachine instances to operate on
+        @param max_workers: maximum number of machines handled at the same
+                            time (default: all of them)
+        '''
+        self._machines = list(machines)
+        if max_workers is None:
+            max_workers = max(1, len(self._machines))
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        # last operation submitted for each machine
+        self._last = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,
+                 exc_type: Optional[Type[BaseException]],
+                 exc_val: Optional[BaseException],
+                 exc_tb: Optional[TracebackType]) -> None:
+        self.shutdown()
+        self._executor.shutdown()
+
+    def __iter__(self):
+        return iter(self._machines)
+
+    def __len__(self):
+        return len(self._machines)
+
+    def map(self, func, timeout=None, machines=None):
+        """
+        Call func(machine) for every machine concurrently
+
+        @param func: callable taking a QEMUMachine
+        @param timeout: seconds to wait for all machines, or None
+        @param machines: subset of the fleet to operate on
+        @return list of FleetResult
+        """
+        if machines is None:
+            machines = self._machines
+        futures = [self._submit(func, machine) for machine in machines]
+        done, _ = concurrent.futures.wait(futures, timeout)
+        return self._results(machines, futures, done, timeout)
+
+    def _submit(self, func, machine):
+        previous = self._last.get(machine)
+
+        def _run():
+            if previous is not None and not previous.cancel():
+                concurrent.futures.wait([previous])
+            return func(machine)
+
+        future = self._executor.submit(_run)
+        self._last[machine] = future
+        return future
+
+    @staticmethod
+    def _results(machines, futures, done, timeout):
+        results = []
+        for machine, future in zip(machines, futures):
+            if future not in done:
+                error = QEMUMachineError('timed out after %s seconds' %
+                                         timeout)
+                results.append(FleetResult(machine, None, error))
+            elif future.exception() is not None:
+                results.append(FleetResult(machine, None, future.exception()))
+            else:
+                results.append(FleetResult(machine, future.result(), None))
+        return results
+
+    def launch(self, timeout=None):
+        """
+        Launch all machines
+        """
+        return self.map(lambda machine: machine.launch(), timeout)
+
+    def qmp(self, cmd, timeout=None, **args):
+        """
+        Send a QMP command to all machines, see QEMUMachine.qmp()
+        """
+        return self.map(lambda machine: machine.qmp(cmd, **args), timeout)
+
+    def command(self, cmd, timeout=None, **args):
+        """
+        Run a QMP command on all machines, see QEMUMachine.command()
+        """
+        return self.map(lambda machine: machine.command(cmd, **args),
+                        timeout)
+
+    def events_wait(self, events, timeout=60.0):
+        """
+        Wait for one of the given events on every machine,
+        see QEMUMachine.events_wait()
+        """
+        return self.map(lambda machine: machine.events_wait(events, timeout),
+                        timeout)
+
+    def shutdown(self, timeout=None, hard=False):
+        """
+        Terminate all running machines and clean up
+
+        Machines that have not terminated when the timeout expires are
+        killed, and get a QEMUMachineError in their result.  The timeout
+        includes waiting for operations that previously timed out.
+        """
+        machines = self._machines
+
+        def _shutdown(machine):
+            machine.shutdown(hard=hard)
+            return machine.exitcode()
+
+        futures = [self._submit(_shutdown, machine) for machine in machines]
+        done, pending = concurrent.futures.wait(futures, timeout)
+        for machine, future in zip(machines, futures):
+            if future in pending:
+                LOG.debug('Killing VM that did not shut down in time: %s',
+                          machine.get_pid())
+                try:
+                    os.kill(machine.get_pid(), signal.SIGKILL)
+                except (OSError, TypeError):
+                    pass
+        # Let the pending shutdown() calls clean up after the kill
+        concurrent.futures.wait(pending, 3)
+        return self._results(machines, futures, done, timeout)
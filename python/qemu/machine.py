@@ -17,7 +17,9 @@ which provides facilities for managing the lifetime of a QEMU VM.
 # Based on qmp.py.
 #
 
+from collections import OrderedDict
 import errno
+import itertools
 import logging
 import os
 import subprocess
@@ -61,6 +63,146 @@ class MonitorResponseError(qmp.QMPError):
         self.reply = reply
 
 
+class QEMUEventStore:
+    """
+    Cache of QMP events that have not been consumed yet
+
+    Events are kept in arrival order and indexed by event name and, for
+    events whose data carries one of INDEX_KEYS, by that key, so that
+    looking up an event matching a query does not need to scan events of
+    other kinds or for other devices.  If max_events is set, only the
+    most recent max_events events are retained.
+    """
+
+    INDEX_KEYS = ('id', 'device', 'node-name')
+
+    def __init__(self, max_events=None):
+        self.max_events = max_events
+        self._seq = itertools.count()
+        self._events = OrderedDict()
+        self._by_name = {}
+        self._by_key = {}
+
+    def __len__(self):
+        return len(self._events)
+
+    @classmethod
+    def _event_keys(cls, event):
+        data = event.get('data')
+        if not isinstance(data, dict):
+            return []
+        return [(event['event'], key, data[key]) for key in cls.INDEX_KEYS
+                if isinstance(data.get(key), (str, int))]
+
+    @classmethod
+    def match_key(cls, name, match):
+        """
+        Return the index key that events matching (name, match) must have,
+        or None if the match criteria do not pin down an indexed value.
+        """
+        if not isinstance(match, dict):
+            return None
+        data = match.get('data')
+        if not isinstance(data, dict):
+            return None
+        for key in cls.INDEX_KEYS:
+            if isinstance(data.get(key), (str, int)):
+                return (name, key, data[key])
+        return None
+
+    @staticmethod
+    def compile_match(match):
+        """
+        Return a predicate equivalent to QEMUMachine.event_match(event, match)
+        """
+        if match is None:
+            return lambda event: True
+        if not isinstance(match, dict):
+            return lambda event: QEMUMachine.event_match(event, match)
+
+        items = [(key, QEMUEventStore.compile_match(value))
+                 for key, value in match.items()]
+
+        def _match(event):
+            try:
+                for key, pred in items:
+                    if key not in event or not pred(event[key]):
+                        return False
+                return True
+            except TypeError:
+                # event wasn't a dict
+                return match == event
+        return _match
+
+    def append(self, event):
+        """
+        Add an event, dropping the oldest one if the store is full.
+        """
+        seq = next(self._seq)
+        self._events[seq] = event
+        self._by_name.setdefault(event['event'], OrderedDict())[seq] = event
+        for key in self._event_keys(event):
+            self._by_key.setdefault(key, OrderedDict())[seq] = event
+        if self.max_events and len(self._events) > self.max_events:
+            dropped = self._remove(next(iter(self._events)))
+            LOG.debug("Dropping unconsumed QMP event: %s", dropped['event'])
+
+    def _remove(self, seq):
+        event = self._events.pop(seq)
+        name = event['event']
+        del self._by_name[name][seq]
+        if not self._by_name[name]:
+            del self._by_name[name]
+        for key in self._event_keys(event):
+            del self._by_key[key][seq]
+            if not self._by_key[key]:
+                del self._by_key[key]
+        return event
+
+    def popleft(self):
+        """
+        Remove and return the oldest event, or None if the store is empty.
+        """
+        if not self._events:
+            return None
+        return self._remove(next(iter(self._events)))
+
+    def drain(self):
+        """
+        Remove and return all events in arrival order.
+        """
+        events = list(self._events.values())
+        self._events.clear()
+        self._by_name.clear()
+        self._by_key.clear()
+        return events
+
+    def pop_match(self, matchers):
+        """
+        Remove and return the oldest event matching any of matchers.
+
+        matchers: a sequence of (name, key, predicate) tuples as built by
+                  match_key() and compile_match().
+        """
+        found = None
+        for name, key, pred in matchers:
+            if key is None:
+                bucket = self._by_name.get(name)
+            else:
+                bucket = self._by_key.get(key)
+            if not bucket:
+                continue
+            for seq, event in bucket.items():
+                if found is not None and seq > found:
+                    break
+                if pred(event):
+                    found = seq
+                    break
+        if found is None:
+            return None
+        return self._remove(found)
+
+
 class QEMUMachine:
     """
     A QEMU VM
@@ -105,7 +247,7 @@ class QEMUMachine:
         self._binary = binary
         self._args = list(args)     # Force copy args in case we modify them
         self._wrapper = wrapper
-        self._events = []
+        self._events = QEMUEventStore()
         self._iolog = None
         self._socket_scm_helper = socket_scm_helper
         self._qmp_set = True   # Enable QMP monitor by default.
@@ -435,7 +577,7 @@ class QEMUMachine:
         Poll for one queued QMP events and return it
         """
         if self._events:
-            return self._events.pop(0)
+            return self._events.popleft()
         return self._qmp.pull_event(wait=wait)
 
     def get_qmp_events(self, wait=False):
@@ -443,8 +585,7 @@ class QEMUMachine:
         Poll for queued QMP events and return a list of dicts
         """
         events = self._qmp.get_events(wait=wait)
-        events.extend(self._events)
-        del self._events[:]
+        events.extend(self._events.drain())
         self._qmp.clear_events()
         return events
 
@@ -501,27 +642,37 @@ class QEMUMachine:
                 See event_match for details.
         timeout: QEMUMonitorProtocol.pull_event timeout parameter.
         """
-        def _match(event):
-            for name, match in events:
-                if event['event'] == name and self.event_match(event, match):
-                    return True
-            return False
+        matchers = [(name, QEMUEventStore.match_key(name, match),
+                     QEMUEventStore.compile_match(match))
+                    for name, match in events]
+        by_name = {}
+        for name, _, pred in matchers:
+            by_name.setdefault(name, []).append(pred)
 
         # Search cached events
-        for event in self._events:
-            if _match(event):
-                self._events.remove(event)
-                return event
+        event = self._events.pop_match(matchers)
+        if event is not None:
+            return event
 
         # Poll for new events
         while True:
             event = self._qmp.pull_event(wait=timeout)
-            if _match(event):
+            if any(pred(event) for pred in by_name.get(event['event'], [])):
                 return event
             self._events.append(event)
 
         return None
 
+    def set_event_retention(self, max_events=None):
+        """
+        Limit the number of unconsumed QMP events kept for events_wait()
+        and get_qmp_event(s).  Older events are dropped first; None keeps
+        all events.
+        """
+        self._events.max_events = max_events
+        while max_events and len(self._events) > max_events:
+            self._events.popleft()
+
     def get_log(self):
         """
         After self.shutdown or failed qemu execution, this returns the output
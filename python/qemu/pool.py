@@ -0,0 +1,191 @@
+"""
+QEMU machine pool module:
+
+The pool module provides the QEMUMachinePool class, which keeps a number
+of QEMU VMs launched and paused in advance, so that handing one out costs
+a QMP 'cont' rather than a full QEMU startup.
+"""
+
+# This work is licensed under the terms of the GNU GPL, version 2.  See
+# the COPYING file in the top-level directory.
+#
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import logging
+import os
+import threading
+from typing import Optional, Type
+from types import TracebackType
+
+from .machine import QEMUMachineError
+
+LOG = logging.getLogger(__name__)
+
+
+class QEMUMachinePool:
+    """
+    A pool of pre-launched QEMU VMs
+
+    Machines are built by factory(name), which must return a QEMUMachine
+    that has not been launched yet; name is unique within the process and
+    should be passed on so that the machines' sockets do not clash.  The
+    pool launches each machine with -S, i.e. with its QMP connection
+    established and capabilities negotiated but the guest paused, and
+    resumes it when it is handed out::
+
+        pool = QEMUMachinePool(lambda name: QEMUMachine(binary, args,
+                                                        name=name), size=4)
+        with pool:
+            with pool.machine() as vm:
+                ...
+            # vm has been shut down and replaced by a fresh one here
+
+    Machines are launched in background threads, up to size at a time, so
+    the pool is refilled while the caller is using the machine it got.
+    """
+
+    def __init__(self, factory, size=1):
+        '''
+        Initialize a QEMUMachinePool
+
+        @param factory: callable building an unlaunched QEMUMachine from
+                        a name
+        @param size: number of idle machines to keep ready
+        @note: No machine is started until fill() or acquire() is used.
+        '''
+        if size < 1:
+            raise ValueError('pool size must be at least 1')
+        self._factory = factory
+        self._size = size
+        self._lock = threading.Lock()
+        self._count = 0
+        self._idle = deque()
+        self._warming = deque()
+        self._closed = False
+        self._executor = ThreadPoolExecutor(max_workers=size)
+
+    def __enter__(self):
+        self.fill()
+        return self
+
+    def __exit__(self,
+                 exc_type: Optional[Type[BaseException]],
+                 exc_val: Optional[BaseException],
+                 exc_tb: Optional[TracebackType]) -> None:
+        self.close()
+
+    def _new_name(self):
+        with self._lock:
+            self._count += 1
+            return 'qemu-%d-pool%d' % (os.getpid(), self._count)
+
+    def _launch(self):
+        machine = self._factory(self._new_name())
+        machine.add_args('-S')
+        machine.launch()
+        return machine
+
+    def fill(self):
+        """
+        Start launching machines until size of them are idle or warming up
+        """
+        with self._lock:
+            if self._closed:
+                raise QEMUMachineError('machine pool is closed')
+            while len(self._idle) + len(self._warming) < self._size:
+                self._warming.append(self._executor.submit(self._launch))
+
+    def _take(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.popleft()
+            if self._warming:
+                future = self._warming.popleft()
+            else:
+                future = None
+        if future is None:
+            return self._launch()
+        try:
+            return future.result()
+        except Exception:  # pylint: disable=broad-except
+            LOG.debug('Pooled VM failed to launch, retrying', exc_info=True)
+            return self._launch()
+
+    def acquire(self, refill=True):
+        """
+        Hand out a running machine
+
+        The machine belongs to the caller until it is passed to release().
+        If refill is true, a replacement starts warming up right away;
+        callers that intend to recycle the machine can pass False and
+        leave refilling to release().
+        """
+        self.fill()
+        machine = self._take()
+        if refill:
+            self.fill()
+        try:
+            machine.command('cont')
+        except Exception:
+            machine.shutdown(hard=True)
+            raise
+        return machine
+
+    def release(self, machine, recycle=False):
+        """
+        Give back a machine obtained from acquire()
+
+        By default the machine is shut down.  With recycle=True it is
+        paused, reset and returned to the idle machines instead; this is
+        only appropriate if the caller did not change the machine's
+        configuration (devices, block graph, ...) while using it.
+        """
+        if recycle and machine.is_running():
+            try:
+                machine.command('stop')
+                machine.command('system_reset')
+                machine.get_qmp_events()
+            except Exception:  # pylint: disable=broad-except
+                LOG.debug('Failed to recycle pooled VM', exc_info=True)
+            else:
+                with self._lock:
+                    if (not self._closed and
+                            len(self._idle) + len(self._warming) <
+                            self._size):
+                        self._idle.append(machine)
+                        return
+        machine.shutdown()
+        if not self._closed:
+            self.fill()
+
+    @contextmanager
+    def machine(self, recycle=False):
+        """
+        Context manager that acquires a machine and releases it on exit
+        """
+        machine = self.acquire(refill=not recycle)
+        try:
+            yield machine
+        finally:
+            self.release(machine, recycle)
+
+    def close(self):
+        """
+        Shut down all idle machines and those still warming up
+        """
+        with self._lock:
+            self._closed = True
+            idle = list(self._idle)
+            warming = list(self._warming)
+            self._idle.clear()
+            self._warming.clear()
+        for future in warming:
+            try:
+                idle.append(future.result())
+            except Exception:  # pylint: disable=broad-except
+                pass
+        for machine in idle:
+            machine.shutdown()
+        self._executor.shutdown()
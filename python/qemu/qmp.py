@@ -11,7 +11,11 @@ import json
 import errno
 import socket
 import logging
+import itertools
 from typing import (
+    Any,
+    Dict,
+    List,
     Optional,
     TextIO,
     Type,
@@ -43,6 +47,12 @@ class QMPTimeoutError(QMPError):
     """
 
 
+class QMPProtocolError(QMPError):
+    """
+    QMP protocol error; unexpected response
+    """
+
+
 class QEMUMonitorProtocol:
     """
     Provide an API to connect to QEMU via QEMU Monitor Protocol (QMP) and then
@@ -65,6 +75,7 @@ class QEMUMonitorProtocol:
               accept() methods
         """
         self.__events = []
+        self.__batch_ids = itertools.count()
         self.__address = address
         self.__sock = self.__get_sock()
         self.__sockfile: Optional[TextIO] = None
@@ -213,6 +224,64 @@ class QEMUMonitorProtocol:
         self.logger.debug("<<< %s", resp)
         return resp
 
+    def cmd_batch(self, qmp_cmds: List[Dict[str, Any]],
+                  window: Optional[int] = None
+                  ) -> Optional[List[Dict[str, Any]]]:
+        """
+        Send several QMP commands without waiting for each reply.
+
+        Each command is tagged with a unique id, and up to `window` commands
+        (all of them by default) are written to the socket at once.  Replies
+        are collected in whatever order they arrive, while events read in
+        between are cached as usual.  An 'id' given in a command is restored
+        in its reply.
+
+        @param qmp_cmds: list of QMP commands to be sent as Python dicts
+        @param window: maximum number of commands in flight, or None
+        @return list of QMP responses in the order of qmp_cmds, or None if
+                the connection has been closed
+        @raise QMPError if a reply cannot be matched to a command
+        """
+        wire_ids = ['__qmp-batch#%d' % next(self.__batch_ids)
+                    for _ in qmp_cmds]
+        index = dict((cmd_id, i) for i, cmd_id in enumerate(wire_ids))
+        replies: List[Optional[Dict[str, Any]]] = [None] * len(qmp_cmds)
+        window = window or len(qmp_cmds)
+        sent = 0
+        received = 0
+        while received < len(qmp_cmds):
+            if sent - received < window and sent < len(qmp_cmds):
+                batch = []
+                while sent - received < window and sent < len(qmp_cmds):
+                    wire_cmd = dict(qmp_cmds[sent])
+                    wire_cmd['id'] = wire_ids[sent]
+                    self.logger.debug(">>> %s", qmp_cmds[sent])
+                    batch.append(json.dumps(wire_cmd))
+                    sent += 1
+                try:
+                    self.__sock.sendall('\n'.join(batch).encode('utf-8'))
+                except OSError as err:
+                    if err.errno == errno.EPIPE:
+                        return None
+                    raise err
+
+            resp = self.__json_read()
+            if resp is None:
+                return None
+            self.logger.debug("<<< %s", resp)
+            try:
+                i = index.pop(resp.get('id'))
+            except (KeyError, TypeError):
+                raise QMPError("Unexpected reply in batch: %s" % resp)
+            if 'id' in qmp_cmds[i]:
+                resp['id'] = qmp_cmds[i]['id']
+            else:
+                del resp['id']
+            replies[i] = resp
+            received += 1
+        # every slot has been filled once all replies are in
+        return [reply for reply in replies if reply is not None]
+
     def cmd(self, name, args=None, cmd_id=None):
         """
         Build a QMP command and send it to the QMP Monitor.
@@ -21,8 +21,12 @@ import json
 import os
 import argparse
 import collections
+import hashlib
+import mmap
+import re
 import struct
 import sys
+import zlib
 
 
 def mkdir_p(path):
@@ -33,21 +37,39 @@ def mkdir_p(path):
 
 
 class MigrationFile(object):
+    S64 = struct.Struct('>q')
+    S32 = struct.Struct('>i')
+    S16 = struct.Struct('>h')
+    S8 = struct.Struct('>b')
+
     def __init__(self, filename):
         self.filename = filename
         self.file = open(self.filename, "rb")
+        # The whole stream is mapped, readers decode it in place and skip
+        # over page payloads by moving self.pos
+        if os.fstat(self.file.fileno()).st_size == 0:
+            raise Exception("Unexpected end of %s at 0x0" % self.filename)
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.pos = 0
+
+    def unpack(self, fmt):
+        if self.pos + fmt.size > len(self.data):
+            raise Exception("Unexpected end of %s at 0x%x" % (self.filename, self.pos))
+        value, = fmt.unpack_from(self.data, self.pos)
+        self.pos += fmt.size
+        return value
 
     def read64(self):
-        return int.from_bytes(self.file.read(8), byteorder='big', signed=True)
+        return self.unpack(self.S64)
 
     def read32(self):
-        return int.from_bytes(self.file.read(4), byteorder='big', signed=True)
+        return self.unpack(self.S32)
 
     def read16(self):
-        return int.from_bytes(self.file.read(2), byteorder='big', signed=True)
+        return self.unpack(self.S16)
 
     def read8(self):
-        return int.from_bytes(self.file.read(1), byteorder='big', signed=True)
+        return self.unpack(self.S8)
 
     def readstr(self, len = None):
         return self.readvar(len).decode('utf-8')
@@ -57,13 +79,21 @@ class MigrationFile(object):
             size = self.read8()
         if size == 0:
             return ""
-        value = self.file.read(size)
-        if len(value) != size:
-            raise Exception("Unexpected end of %s at 0x%x" % (self.filename, self.file.tell()))
+        if self.pos + size > len(self.data):
+            raise Exception("Unexpected end of %s at 0x%x" % (self.filename, len(self.data)))
+        value = self.data[self.pos:self.pos + size]
+        self.pos += size
         return value
 
+    def seek(self, offset, whence = os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += len(self.data)
+        self.pos = offset
+
     def tell(self):
-        return self.file.tell()
+        return self.pos
 
     # The VMSD description is at the end of the file, after EOF. Look for
     # the last NULL byte, then for the beginning brace of JSON.
@@ -71,37 +101,68 @@ class MigrationFile(object):
         QEMU_VM_VMDESCRIPTION = 0x06
 
         # Remember the offset in the file when we started
-        entrypos = self.file.tell()
-
-        # Read the last 10MB
-        self.file.seek(0, os.SEEK_END)
-        endpos = self.file.tell()
-        self.file.seek(max(-endpos, -10 * 1024 * 1024), os.SEEK_END)
-        datapos = self.file.tell()
-        data = self.file.read()
-        # The full file read closed the file as well, reopen it
-        self.file = open(self.filename, "rb")
+        entrypos = self.pos
+
+        # Search the last 10MB
+        datapos = max(0, len(self.data) - 10 * 1024 * 1024)
 
         # Find the last NULL byte, then the first brace after that. This should
         # be the beginning of our JSON data.
-        nulpos = data.rfind(b'\0')
-        jsonpos = data.find(b'{', nulpos)
+        nulpos = self.data.rfind(b'\0', datapos)
+        jsonpos = self.data.find(b'{', nulpos)
 
         # Check backwards from there and see whether we guessed right
-        self.file.seek(datapos + jsonpos - 5, 0)
+        self.pos = jsonpos - 5
         if self.read8() != QEMU_VM_VMDESCRIPTION:
             raise Exception("No Debug Migration device found")
 
         jsonlen = self.read32()
 
         # Seek back to where we were at the beginning
-        self.file.seek(entrypos, 0)
+        self.pos = entrypos
 
-        return data[jsonpos:jsonpos + jsonlen]
+        return self.data[jsonpos:jsonpos + jsonlen]
 
     def close(self):
+        self.data.close()
         self.file.close()
 
+# Apply the XBZRLE encoded page at offset in data to page, a bytearray
+# holding the previous contents of the page.  Returns the offset after
+# the encoded page.
+def xbzrle_decode(data, offset, page):
+    ENCODING_FLAG_XBZRLE = 0x1
+
+    if data[offset] != ENCODING_FLAG_XBZRLE:
+        raise Exception("Unknown XBZRLE encoding 0x%x at 0x%x" % (data[offset], offset))
+    i = offset + 3
+    end = i + ((data[offset + 1] << 8) | data[offset + 2])
+    if end > len(data):
+        raise Exception("Unexpected end of stream at 0x%x" % len(data))
+    d = 0
+    # The encoding alternates runs of unchanged bytes and runs of new
+    # bytes, each preceded by its length as 1 or 2 bytes of LEB128
+    while i < end:
+        count = data[i]
+        if count & 0x80:
+            count = (count & 0x7f) | (data[i + 1] << 7)
+            i += 2
+        else:
+            i += 1
+        d += count
+        count = data[i]
+        if count & 0x80:
+            count = (count & 0x7f) | (data[i + 1] << 7)
+            i += 2
+        else:
+            i += 1
+        if count == 0 or d + count > len(page) or i + count > end:
+            raise Exception("Invalid XBZRLE page at 0x%x" % offset)
+        page[d:d + count] = data[i:i + count]
+        d += count
+        i += count
+    return end
+
 class RamSection(object):
     RAM_SAVE_FLAG_COMPRESS = 0x02
     RAM_SAVE_FLAG_MEM_SIZE = 0x04
@@ -111,21 +172,38 @@ class RamSection(object):
     RAM_SAVE_FLAG_XBZRLE   = 0x40
     RAM_SAVE_FLAG_HOOK     = 0x80
 
+    # Values of the per-page kind maps kept while extracting memory
+    PAGE_KIND_NONE = 0   # not in the stream
+    PAGE_KIND_ZERO = 1   # filled with zeroes, left as a hole
+    PAGE_KIND_FILL = 2   # filled with another byte
+    PAGE_KIND_DATA = 3   # contents in the stream
+
+    # Pages written with a single pwritev()
+    MAX_WRITE_PAGES = 1024
+
     def __init__(self, file, version_id, ramargs, section_key):
-        if version_id != 4:
+        # Version 3 streams have a single RAM block and no block names
+        if version_id not in (3, 4):
             raise Exception("Unknown RAM version %d" % version_id)
 
         self.file = file
+        self.version_id = version_id
         self.section_key = section_key
         self.TARGET_PAGE_SIZE = ramargs['page_size']
         self.dump_memory = ramargs['dump_memory']
         self.write_memory = ramargs['write_memory']
+        self.write_page_kinds = ramargs.get('write_page_kinds', False)
         self.sizeinfo = collections.OrderedDict()
         self.data = collections.OrderedDict()
         self.data['section sizes'] = self.sizeinfo
         self.name = ''
         if self.write_memory:
             self.files = { }
+            self.page_kinds = { }
+            self.pending_name = None
+            self.pending_addr = 0
+            self.pending = []
+            self.fill_pages = { 0: bytes(self.TARGET_PAGE_SIZE) }
         if self.dump_memory:
             self.memory = collections.OrderedDict()
             self.data['memory'] = self.memory
@@ -139,69 +217,69 @@ class RamSection(object):
     def getDict(self):
         return self.data
 
-    def read(self):
+    def pages(self):
+        """
+        Walk a RAM section part, yielding (block, addr, kind, offset) for
+        each page, where kind is 'fill', 'page' or 'xbzrle' and offset is
+        the position of the fill byte, the page contents or the XBZRLE
+        encoded page (see xbzrle_decode()) in the stream.
+        """
+        f = self.file
+        data = f.data
+        end = len(data)
+        page_size = self.TARGET_PAGE_SIZE
+        page_mask = page_size - 1
+        unpack_addr = struct.Struct('>Q').unpack_from
+        pos = f.pos
+        name = self.name
         # Read all RAM sections
         while True:
-            addr = self.file.read64()
-            flags = addr & (self.TARGET_PAGE_SIZE - 1)
-            addr &= ~(self.TARGET_PAGE_SIZE - 1)
+            if pos + 8 > end:
+                raise Exception("Unexpected end of %s at 0x%x" % (f.filename, end))
+            addr, = unpack_addr(data, pos)
+            pos += 8
+            flags = addr & page_mask
+            addr &= ~page_mask
 
             if flags & self.RAM_SAVE_FLAG_MEM_SIZE:
-                while True:
-                    namelen = self.file.read8()
-                    # We assume that no RAM chunk is big enough to ever
-                    # hit the first byte of the address, so when we see
-                    # a zero here we know it has to be an address, not the
-                    # length of the next block.
-                    if namelen == 0:
-                        self.file.file.seek(-1, 1)
-                        break
-                    self.name = self.file.readstr(len = namelen)
-                    len = self.file.read64()
-                    self.sizeinfo[self.name] = '0x%016x' % len
-                    if self.write_memory:
-                        print(self.name)
-                        mkdir_p('./' + os.path.dirname(self.name))
-                        f = open('./' + self.name, "wb")
-                        f.truncate(0)
-                        f.truncate(len)
-                        self.files[self.name] = f
+                if self.version_id == 3:
+                    # addr is the total RAM size
+                    self.add_block('ram', addr)
+                else:
+                    f.pos = pos
+                    self.read_block_sizes()
+                    pos = f.pos
+                name = self.name
                 flags &= ~self.RAM_SAVE_FLAG_MEM_SIZE
 
-            if flags & self.RAM_SAVE_FLAG_COMPRESS:
+            if flags & (self.RAM_SAVE_FLAG_COMPRESS | self.RAM_SAVE_FLAG_PAGE |
+                        self.RAM_SAVE_FLAG_XBZRLE):
                 if flags & self.RAM_SAVE_FLAG_CONTINUE:
                     flags &= ~self.RAM_SAVE_FLAG_CONTINUE
+                elif self.version_id == 3:
+                    pass
                 else:
-                    self.name = self.file.readstr()
-                fill_char = self.file.read8()
-                # The page in question is filled with fill_char now
-                if self.write_memory and fill_char != 0:
-                    self.files[self.name].seek(addr, os.SEEK_SET)
-                    self.files[self.name].write(chr(fill_char) * self.TARGET_PAGE_SIZE)
-                if self.dump_memory:
-                    self.memory['%s (0x%016x)' % (self.name, addr)] = 'Filled with 0x%02x' % fill_char
-                flags &= ~self.RAM_SAVE_FLAG_COMPRESS
-            elif flags & self.RAM_SAVE_FLAG_PAGE:
-                if flags & self.RAM_SAVE_FLAG_CONTINUE:
-                    flags &= ~self.RAM_SAVE_FLAG_CONTINUE
+                    namelen = data[pos]
+                    name = str(data[pos + 1:pos + 1 + namelen], 'utf-8')
+                    self.name = name
+                    pos += 1 + namelen
+                if flags & self.RAM_SAVE_FLAG_COMPRESS:
+                    # The page in question is filled with the byte at pos
+                    kind, size = 'fill', 1
+                    flags &= ~self.RAM_SAVE_FLAG_COMPRESS
+                elif flags & self.RAM_SAVE_FLAG_PAGE:
+                    kind, size = 'page', page_size
+                    flags &= ~self.RAM_SAVE_FLAG_PAGE
                 else:
-                    self.name = self.file.readstr()
-
-                if self.write_memory or self.dump_memory:
-                    data = self.file.readvar(size = self.TARGET_PAGE_SIZE)
-                else: # Just skip RAM data
-                    self.file.file.seek(self.TARGET_PAGE_SIZE, 1)
-
-                if self.write_memory:
-                    self.files[self.name].seek(addr, os.SEEK_SET)
-                    self.files[self.name].write(data)
-                if self.dump_memory:
-                    hexdata = " ".join("{0:02x}".format(ord(c)) for c in data)
-                    self.memory['%s (0x%016x)' % (self.name, addr)] = hexdata
-
-                flags &= ~self.RAM_SAVE_FLAG_PAGE
-            elif flags & self.RAM_SAVE_FLAG_XBZRLE:
-                raise Exception("XBZRLE RAM compression is not supported yet")
+                    # Encoding flag, be16 length, encoded data
+                    if pos + 3 > end:
+                        raise Exception("Unexpected end of %s at 0x%x" % (f.filename, end))
+                    kind, size = 'xbzrle', 3 + ((data[pos + 1] << 8) | data[pos + 2])
+                    flags &= ~self.RAM_SAVE_FLAG_XBZRLE
+                if pos + size > end:
+                    raise Exception("Unexpected end of %s at 0x%x" % (f.filename, end))
+                yield name, addr, kind, pos
+                pos += size
             elif flags & self.RAM_SAVE_FLAG_HOOK:
                 raise Exception("RAM hooks don't make sense with files")
 
@@ -211,6 +289,136 @@ class RamSection(object):
 
             if flags != 0:
                 raise Exception("Unknown RAM flags: %x" % flags)
+        f.pos = pos
+
+    def read_block_sizes(self):
+        while True:
+            namelen = self.file.read8()
+            # We assume that no RAM chunk is big enough to ever
+            # hit the first byte of the address, so when we see
+            # a zero here we know it has to be an address, not the
+            # length of the next block.
+            if namelen == 0:
+                self.file.seek(-1, os.SEEK_CUR)
+                break
+            self.add_block(self.file.readstr(len = namelen), self.file.read64())
+
+    def add_block(self, name, len):
+        self.name = name
+        self.sizeinfo[self.name] = '0x%016x' % len
+        if self.write_memory:
+            print(self.name)
+            mkdir_p('./' + os.path.dirname(self.name))
+            f = open('./' + self.name, "w+b")
+            f.truncate(0)
+            f.truncate(len)
+            self.files[self.name] = f
+            self.page_kinds[self.name] = bytearray(len // self.TARGET_PAGE_SIZE)
+
+    # Queue a page for writing, pages at consecutive addresses are written
+    # together straight from the stream mapping
+    def write_page(self, name, addr, buf):
+        if self.pending and (name != self.pending_name or
+                             addr != self.pending_addr + len(self.pending) * self.TARGET_PAGE_SIZE or
+                             len(self.pending) >= self.MAX_WRITE_PAGES):
+            self.flush_pages()
+        if not self.pending:
+            self.pending_name = name
+            self.pending_addr = addr
+        self.pending.append(buf)
+
+    def flush_pages(self):
+        if not self.pending:
+            return
+        fd = self.files[self.pending_name].fileno()
+        if hasattr(os, 'pwritev'):
+            written = os.pwritev(fd, self.pending, self.pending_addr)
+        else:
+            written = 0
+        if written < len(self.pending) * self.TARGET_PAGE_SIZE:
+            rest = b''.join(self.pending)[written:]
+            os.lseek(fd, self.pending_addr + written, os.SEEK_SET)
+            while rest:
+                rest = rest[os.write(fd, rest):]
+        self.pending = []
+
+    def extract_page(self, name, addr, kind, buf):
+        kinds = self.page_kinds[name]
+        index = addr // self.TARGET_PAGE_SIZE
+        # Zero pages stay holes unless they overwrite earlier contents
+        if kind != self.PAGE_KIND_ZERO or kinds[index] > self.PAGE_KIND_ZERO:
+            self.write_page(name, addr, buf)
+        kinds[index] = kind
+
+    # Contents of a page before an XBZRLE update, taken from what has been
+    # extracted or dumped so far
+    def previous_page(self, name, addr):
+        page_size = self.TARGET_PAGE_SIZE
+        if self.write_memory:
+            self.flush_pages()
+            page = os.pread(self.files[name].fileno(), page_size, addr)
+            return bytearray(page.ljust(page_size, b'\0'))
+        if self.dump_memory:
+            old = self.memory.get('%s (0x%016x)' % (name, addr), '')
+            if old.startswith('Filled with '):
+                return bytearray([int(old[12:], 16)]) * page_size
+            if old:
+                return bytearray.fromhex(old)
+        return bytearray(page_size)
+
+    def read(self):
+        data = self.file.data
+        view = memoryview(data)
+        page_size = self.TARGET_PAGE_SIZE
+        try:
+            for name, addr, kind, offset in self.pages():
+                if kind == 'fill':
+                    fill_char = data[offset]
+                    # The page in question is filled with fill_char now
+                    if self.write_memory:
+                        if fill_char not in self.fill_pages:
+                            self.fill_pages[fill_char] = bytes([fill_char]) * page_size
+                        self.extract_page(name, addr,
+                                          self.PAGE_KIND_FILL if fill_char else self.PAGE_KIND_ZERO,
+                                          self.fill_pages[fill_char])
+                    if self.dump_memory:
+                        self.memory['%s (0x%016x)' % (name, addr)] = 'Filled with 0x%02x' % fill_char
+                    continue
+
+                if kind == 'xbzrle':
+                    if not self.write_memory and not self.dump_memory:
+                        # Nobody looks at the page contents
+                        continue
+                    page = self.previous_page(name, addr)
+                    xbzrle_decode(data, offset, page)
+                    if self.write_memory:
+                        self.extract_page(name, addr, self.PAGE_KIND_DATA, bytes(page))
+                    if self.dump_memory:
+                        self.memory['%s (0x%016x)' % (name, addr)] = " ".join("{0:02x}".format(c) for c in page)
+                    continue
+
+                if self.write_memory:
+                    self.extract_page(name, addr, self.PAGE_KIND_DATA,
+                                      view[offset:offset + page_size])
+                if self.dump_memory:
+                    hexdata = " ".join("{0:02x}".format(c) for c in data[offset:offset + page_size])
+                    self.memory['%s (0x%016x)' % (name, addr)] = hexdata
+            if self.write_memory:
+                self.flush_pages()
+        finally:
+            # Do not keep references into the mapping
+            if self.write_memory:
+                self.pending = []
+            view.release()
+
+    def close(self):
+        if self.write_memory:
+            for key in self.files:
+                self.files[key].close()
+                if self.write_page_kinds:
+                    with open('./' + key + '.kinds', "wb") as f:
+                        f.write(self.page_kinds[key])
+            self.files = { }
 
     def __del__(self):
         if self.write_memory:
@@ -494,9 +702,25 @@ class MigrationDump(object):
         self.filename = filename
         self.vmsd_desc = None
 
-    def read(self, desc_only = False, dump_memory = False, write_memory = False):
+    def read(self, desc_only = False, dump_memory = False, write_memory = False,
+             write_page_kinds = False):
+        for page in self.walk(desc_only, dump_memory, write_memory,
+                              write_page_kinds = write_page_kinds):
+            pass
+
+    def pages(self):
+        """
+        Iterate over all RAM pages of the stream as (block, addr, kind,
+        offset) tuples, see RamSection.pages().  Device state is read
+        along the way and available from getDict() afterwards.
+        """
+        return self.walk(ram_pages = True)
+
+    def walk(self, desc_only = False, dump_memory = False, write_memory = False,
+             ram_pages = False, write_page_kinds = False):
         # Read in the whole file
         file = MigrationFile(self.filename)
+        self.file = file
 
         # File magic
         data = file.read32()
@@ -514,19 +738,31 @@ class MigrationDump(object):
         self.sections = collections.OrderedDict()
 
         if desc_only:
+            file.close()
             return
 
         ramargs = {}
         ramargs['page_size'] = self.vmsd_desc['page_size']
         ramargs['dump_memory'] = dump_memory
         ramargs['write_memory'] = write_memory
+        ramargs['write_page_kinds'] = write_page_kinds
         self.section_classes[('ram',0)][1] = ramargs
 
+        # Bytes of the stream taken by each section, including its parts
+        # and footers
+        self.section_sizes = collections.OrderedDict()
+        label = None
+        start = file.tell()
+
         while True:
+            if label is not None:
+                self.section_sizes[label] = self.section_sizes.get(label, 0) + file.tell() - start
+            start = file.tell()
             section_type = file.read8()
             if section_type == self.QEMU_VM_EOF:
                 break
             elif section_type == self.QEMU_VM_CONFIGURATION:
+                label = 'configuration'
                 section = ConfigurationSection(file)
                 section.read()
             elif section_type == self.QEMU_VM_SECTION_START or section_type == self.QEMU_VM_SECTION_FULL:
@@ -538,18 +774,30 @@ class MigrationDump(object):
                 classdesc = self.section_classes[section_key]
                 section = classdesc[0](file, version_id, classdesc[1], section_key)
                 self.sections[section_id] = section
-                section.read()
+                label = "%s (%d)" % (name, section_id)
+                yield from self.read_section(section, ram_pages)
             elif section_type == self.QEMU_VM_SECTION_PART or section_type == self.QEMU_VM_SECTION_END:
                 section_id = file.read32()
-                self.sections[section_id].read()
+                section = self.sections[section_id]
+                label = "%s (%d)" % (section.section_key[0], section_id)
+                yield from self.read_section(section, ram_pages)
             elif section_type == self.QEMU_VM_SECTION_FOOTER:
                 read_section_id = file.read32()
                 if read_section_id != section_id:
                     raise Exception("Mismatched section footer: %x vs %x" % (read_section_id, section_id))
             else:
                 raise Exception("Unknown section type: %d" % section_type)
+        for section in self.sections.values():
+            if isinstance(section, RamSection):
+                section.close()
         file.close()
 
+    def read_section(self, section, ram_pages):
+        if ram_pages and isinstance(section, RamSection):
+            yield from section.pages()
+        else:
+            section.read()
+
     def load_vmsd_json(self, file):
         vmsd_json = file.read_migration_debug_json()
         self.vmsd_desc = json.loads(vmsd_json, object_pairs_hook=collections.OrderedDict)
@@ -565,6 +813,140 @@ class MigrationDump(object):
            r[key] = value.getDict()
         return r
 
+class MigrationStats(object):
+    """
+    Statistics about the RAM pages of a migration stream: page kinds per
+    RAM block, duplicate page contents, the stream size of each section
+    and estimates of what XBZRLE and multifd zlib compression would save.
+
+    Memory use is bounded: duplicates are counted on a hash-based sample
+    of at most hash_limit distinct pages, and XBZRLE is simulated with a
+    page cache of xbzrle_cache_size bytes, like QEMU's.  Only one data
+    page out of zlib_sample is compressed to estimate the zlib savings.
+    """
+
+    def __init__(self, filename, xbzrle_cache_size = 64 * 1024 * 1024,
+                 hash_limit = 1 << 20, zlib_level = 1, zlib_sample = 8):
+        self.filename = filename
+        self.xbzrle_cache_size = xbzrle_cache_size
+        self.hash_limit = hash_limit
+        self.zlib_level = zlib_level
+        self.zlib_sample = zlib_sample
+        self.data = collections.OrderedDict()
+
+    # Estimated size of the XBZRLE encoding of new against old, None if
+    # QEMU would send the page in full
+    def xbzrle_size(self, old, new):
+        page_size = len(new)
+        diff = (int.from_bytes(old, 'big') ^ int.from_bytes(new, 'big')).to_bytes(page_size, 'big')
+        changed = page_size - diff.count(0)
+        # Each changed byte is sent as is, runs are preceded by lengths
+        if changed > page_size // 2:
+            return None
+        size = changed
+        for run in re.finditer(b'[^\0]+', diff):
+            size += 2 if run.end() - run.start() < 128 else 4
+        return size if size < page_size else None
+
+    def read(self):
+        dump = MigrationDump(self.filename)
+        blocks = collections.OrderedDict()
+        sent = {}
+        xbzrle_cache = collections.OrderedDict()
+        xbzrle_pages = 0
+        xbzrle_saved = 0
+        data_bytes = 0
+        zlib_input = 0
+        zlib_bytes = 0
+        hashes = {}
+        sample_mask = 0
+
+        for name, addr, kind, offset in dump.pages():
+            page_size = dump.vmsd_desc['page_size']
+            if name not in blocks:
+                blocks[name] = collections.OrderedDict((k, 0) for k in
+                    ('pages', 'zero', 'filled', 'data', 'xbzrle', 'resent', 'duplicate'))
+                sent[name] = bytearray()
+            stats = blocks[name]
+            stats['pages'] += 1
+
+            index = addr // page_size
+            seen = sent[name]
+            if index >= len(seen):
+                seen.extend(bytes(max(index + 1 - len(seen), len(seen))))
+            if seen[index]:
+                stats['resent'] += 1
+            seen[index] = 1
+
+            key = (name, addr)
+            if kind == 'fill':
+                stats['zero' if dump.file.data[offset] == 0 else 'filled'] += 1
+                xbzrle_cache.pop(key, None)
+                continue
+
+            if kind == 'xbzrle':
+                stats['xbzrle'] += 1
+                # Keep following the page if its previous contents are known
+                old = xbzrle_cache.pop(key, None)
+                if old is not None:
+                    page = bytearray(old)
+                    xbzrle_decode(dump.file.data, offset, page)
+                    xbzrle_cache[key] = bytes(page)
+                continue
+
+            stats['data'] += 1
+            page = dump.file.data[offset:offset + page_size]
+
+            old = xbzrle_cache.pop(key, None)
+            if old is not None:
+                size = self.xbzrle_size(old, page)
+                if size is not None:
+                    xbzrle_pages += 1
+                    xbzrle_saved += page_size - size
+            xbzrle_cache[key] = page
+            if len(xbzrle_cache) * page_size > self.xbzrle_cache_size:
+                xbzrle_cache.popitem(last = False)
+
+            if stats['data'] % self.zlib_sample == 0:
+                zlib_input += page_size
+                zlib_bytes += len(zlib.compress(page, self.zlib_level))
+            data_bytes += page_size
+
+            digest = hashlib.sha1(page).digest()[:8]
+            if int.from_bytes(digest, 'little') & sample_mask == 0:
+                count = hashes.get(digest, 0)
+                if count:
+                    stats['duplicate'] += sample_mask + 1
+                hashes[digest] = count + 1
+                if len(hashes) > self.hash_limit:
+                    # Sample half as many pages from now on
+                    sample_mask = (sample_mask << 1) | 1
+                    hashes = dict((h, c) for (h, c) in hashes.items()
+                                  if int.from_bytes(h, 'little') & sample_mask == 0)
+
+        self.data['ram blocks'] = blocks
+        self.data['section sizes'] = dump.section_sizes
+        sampled = sum(hashes.values())
+        self.data['duplicate data pages'] = collections.OrderedDict([
+            ('estimated', (sampled - len(hashes)) * (sample_mask + 1)),
+            ('sampling rate', '1/%d' % (sample_mask + 1)),
+        ])
+        self.data['xbzrle'] = collections.OrderedDict([
+            ('cache size', self.xbzrle_cache_size),
+            ('encoded pages', xbzrle_pages),
+            ('bytes saved', xbzrle_saved),
+        ])
+        if zlib_input:
+            zlib_bytes = zlib_bytes * data_bytes // zlib_input
+        self.data['multifd zlib'] = collections.OrderedDict([
+            ('data bytes', data_bytes),
+            ('estimated compressed bytes', zlib_bytes),
+            ('estimated bytes saved', data_bytes - zlib_bytes),
+        ])
+
+    def getDict(self):
+        return self.data
+
 ###############################################################################
 
 class JSONEncoder(json.JSONEncoder):
@@ -573,40 +955,46 @@ class JSONEncoder(json.JSONEncoder):
             return str(o)
         return json.JSONEncoder.default(self, o)
 
-parser = argparse.ArgumentParser()
-parser.add_argument("-f", "--file", help='migration dump to read from', required=True)
-parser.add_argument("-m", "--memory", help='dump RAM contents as well', action='store_true')
-parser.add_argument("-d", "--dump", help='what to dump ("state" or "desc")', default='state')
-parser.add_argument("-x", "--extract", help='extract contents into individual files', action='store_true')
-args = parser.parse_args()
-
-jsonenc = JSONEncoder(indent=4, separators=(',', ': '))
-
-if args.extract:
-    dump = MigrationDump(args.file)
-
-    dump.read(desc_only = True)
-    print("desc.json")
-    f = open("desc.json", "wb")
-    f.truncate()
-    f.write(jsonenc.encode(dump.vmsd_desc))
-    f.close()
-
-    dump.read(write_memory = True)
-    dict = dump.getDict()
-    print("state.json")
-    f = open("state.json", "wb")
-    f.truncate()
-    f.write(jsonenc.encode(dict))
-    f.close()
-elif args.dump == "state":
-    dump = MigrationDump(args.file)
-    dump.read(dump_memory = args.memory)
-    dict = dump.getDict()
-    print(jsonenc.encode(dict))
-elif args.dump == "desc":
-    dump = MigrationDump(args.file)
-    dump.read(desc_only = True)
-    print(jsonenc.encode(dump.vmsd_desc))
-else:
-    raise Exception("Please specify either -x, -d state or -d dump")
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--file", help='migration dump to read from', required=True)
+    parser.add_argument("-m", "--memory", help='dump RAM contents as well', action='store_true')
+    parser.add_argument("-d", "--dump", help='what to dump ("state", "desc" or "stats")', default='state')
+    parser.add_argument("-x", "--extract", help='extract contents into individual files', action='store_true')
+    parser.add_argument("-k", "--page-kinds", help='with -x, also write a map of page kinds (0 absent, 1 zero, 2 filled, 3 data) per RAM block', action='store_true')
+    args = parser.parse_args()
+
+    jsonenc = JSONEncoder(indent=4, separators=(',', ': '))
+
+    if args.extract:
+        dump = MigrationDump(args.file)
+
+        dump.read(desc_only = True)
+        print("desc.json")
+        f = open("desc.json", "w")
+        f.truncate()
+        f.write(jsonenc.encode(dump.vmsd_desc))
+        f.close()
+
+        dump.read(write_memory = True, write_page_kinds = args.page_kinds)
+        dict = dump.getDict()
+        print("state.json")
+        f = open("state.json", "w")
+        f.truncate()
+        f.write(jsonenc.encode(dict))
+        f.close()
+    elif args.dump == "state":
+        dump = MigrationDump(args.file)
+        dump.read(dump_memory = args.memory)
+        dict = dump.getDict()
+        print(jsonenc.encode(dict))
+    elif args.dump == "stats":
+        stats = MigrationStats(args.file)
+        stats.read()
+        print(jsonenc.encode(stats.getDict()))
+    elif args.dump == "desc":
+        dump = MigrationDump(args.file)
+        dump.read(desc_only = True)
+        print(jsonenc.encode(dump.vmsd_desc))
+    else:
+        raise Exception("Please specify either -x, -d state, -d desc or -d stats")
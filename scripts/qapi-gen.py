@@ -9,6 +9,7 @@ import argparse
 import re
 import sys
 
+from qapi.cache import QAPIGenCache
 from qapi.commands import gen_commands
 from qapi.doc import gen_doc
 from qapi.events import gen_events
@@ -30,6 +31,8 @@ def main(argv):
     parser.add_argument('-u', '--unmask-non-abi-names', action='store_true',
                         dest='unmask',
                         help="expose non-ABI names in introspection")
+    parser.add_argument('--no-cache', action='store_false', dest='cache',
+                        help="regenerate even if no input changed")
     parser.add_argument('schema', action='store')
     args = parser.parse_args()
 
@@ -40,6 +43,12 @@ def main(argv):
               file=sys.stderr)
         sys.exit(1)
 
+    cache = QAPIGenCache(args.output_dir, args.prefix,
+                         [args.builtins, args.prefix, args.unmask,
+                          args.schema])
+    if args.cache and cache.is_valid():
+        return
+
     try:
         schema = QAPISchema(args.schema)
     except QAPIError as err:
@@ -52,6 +61,7 @@ def main(argv):
     gen_events(schema, args.output_dir, args.prefix)
     gen_introspect(schema, args.output_dir, args.prefix, args.unmask)
     gen_doc(schema, args.output_dir, args.prefix)
+    cache.save(schema)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,78 @@
+#
+# QAPI generation cache
+#
+# This work is licensed under the terms of the GNU GPL, version 2.
+# See the COPYING file in the top-level directory.
+
+import hashlib
+import json
+import os
+
+from qapi import gen
+
+
+def _file_hash(fname):
+    with open(fname, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _output_stamp(fname):
+    st = os.stat(fname)
+    return [st.st_size, st.st_mtime_ns]
+
+
+class QAPIGenCache:
+    """Remember the inputs and outputs of a qapi-gen run.
+
+    The cache records the hash of every schema module, of the generator
+    sources and of the command line options, along with the size and
+    mtime of every output file.  If none of them changed, running the
+    generator again would produce the same files, so it can be skipped
+    altogether, without even parsing the schema.
+    """
+
+    def __init__(self, output_dir, prefix, options):
+        self.fname = os.path.join(output_dir, prefix + 'qapi-gen-cache.json')
+        generator = hashlib.sha256()
+        srcdir = os.path.dirname(os.path.abspath(__file__))
+        for name in sorted(os.listdir(srcdir)) + ['../qapi-gen.py']:
+            if name.endswith('.py'):
+                generator.update(_file_hash(os.path.join(srcdir, name))
+                                 .encode())
+        self._key = {'generator': generator.hexdigest(),
+                     'options': options}
+
+    def _load(self):
+        try:
+            with open(self.fname) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def is_valid(self):
+        data = self._load()
+        if data is None or data.get('key') != self._key:
+            return False
+        try:
+            for fname, digest in data['modules'].items():
+                if _file_hash(fname) != digest:
+                    return False
+            for fname, stamp in data['outputs'].items():
+                if _output_stamp(fname) != stamp:
+                    return False
+        except OSError:
+            return False
+        return True
+
+    def save(self, schema):
+        data = {
+            'key': self._key,
+            'modules': {fname: _file_hash(fname)
+                        for fname in schema.module_fnames()},
+            'outputs': {fname: _output_stamp(fname)
+                        for fname in gen.written_files},
+        }
+        tmp = self.fname + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.fname)
@@ -21,6 +21,10 @@ from qapi.common import *
 from qapi.schema import QAPISchemaVisitor
 
 
+# Files written by QAPIGen.write(), changed or not
+written_files = []
+
+
 class QAPIGen:
 
     def __init__(self, fname):
@@ -66,6 +70,7 @@ class QAPIGen:
             f.truncate(0)
             f.write(text)
         f.close()
+        written_files.append(pathname)
 
 
 def _wrap_ifcond(ifcond, before, after):
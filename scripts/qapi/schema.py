@@ -877,6 +877,10 @@ class QAPISchema:
             self._module_dict[name] = QAPISchemaModule(name)
         return self._module_dict[name]
 
+    def module_fnames(self):
+        return [os.path.join(self._schema_dir, name)
+                for name in self._module_dict if name is not None]
+
     def module_by_fname(self, fname):
         name = self._module_name(fname)
         assert name in self._module_dict
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+#
+# Convert a simple trace backend binary trace file to columnar tables
+#
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+import argparse
+import simpletrace
+from tracetool import read_events
+
+def get_args():
+    "Grab options"
+    parser = argparse.ArgumentParser(
+        description="Write one columnar table per trace event, see "
+                    "simpletrace.export_columns() for the layout.")
+    parser.add_argument("--batch-size", type=int, default=65536,
+                        help="records converted at once")
+    parser.add_argument("--dict-size", type=int,
+                        help="distinct strings per column kept in memory "
+                             "(default: no limit)")
+    parser.add_argument("--no-header", action="store_true",
+                        help="trace file has no log header")
+    parser.add_argument("events", type=str, help='trace events file')
+    parser.add_argument("tracefile", type=str, help='trace file read from')
+    parser.add_argument("outdir", type=str, help='output directory')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = get_args()
+
+    events = read_events(open(args.events, 'r'), args.events)
+    edict, idtoname = simpletrace.build_tables(events, not args.no_header)
+    with open(args.tracefile, 'rb') as log:
+        if not args.no_header:
+            simpletrace.read_trace_header(log)
+        rows = simpletrace.export_columns(edict, idtoname, log, args.outdir,
+                                          args.batch_size, args.dict_size)
+
+    for name, count in sorted(rows.items()):
+        print("%s: %d rows" % (name, count))
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+#
+# Compute latency histograms between pairs of trace events
+#
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+import argparse
+import simpletrace
+
+def get_args():
+    "Grab options"
+    parser = argparse.ArgumentParser(
+        description="Match begin and end events on a key argument and "
+                    "print latency percentiles in nanoseconds, e.g. "
+                    "qemu_mutex_locked qemu_mutex_unlock --key mutex")
+    parser.add_argument("--key", type=str, required=True,
+                        help="argument of the begin event to match on")
+    parser.add_argument("--end-key", type=str,
+                        help="argument of the end event to match on "
+                             "(default: same as --key)")
+    parser.add_argument("--group", action="store_true",
+                        help="also report each key value separately")
+    parser.add_argument("--max-pending", type=int, default=1 << 20,
+                        help="begin events kept waiting for their end")
+    parser.add_argument("--max-groups", type=int, default=1 << 16,
+                        help="key values reported separately with --group")
+    parser.add_argument("--percentiles", type=str, default="50,90,99,99.9",
+                        help="comma separated list of percentiles")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of worker processes")
+    parser.add_argument("events", type=str, help='trace events file')
+    parser.add_argument("tracefile", type=str, help='trace file read from')
+    parser.add_argument("begin", type=str, help='begin event name')
+    parser.add_argument("end", type=str, help='end event name')
+    args = parser.parse_args()
+    args.percentiles = [float(p) if '.' in p else int(p)
+                        for p in args.percentiles.split(',')]
+    if not all(0 <= p <= 100 for p in args.percentiles):
+        parser.error("percentiles must be between 0 and 100")
+    return args
+
+if __name__ == '__main__':
+    args = get_args()
+
+    analyzer = simpletrace.LatencyAnalyzer(args.begin, args.end, args.key,
+                                           args.end_key, args.group,
+                                           args.max_pending,
+                                           max_groups=args.max_groups)
+    simpletrace.process_parallel(args.events, args.tracefile, analyzer,
+                                 jobs=args.jobs)
+    for line in analyzer.report(args.percentiles):
+        print(line)
@@ -9,9 +9,16 @@
 #
 # For help see docs/devel/tracing.txt
 
+import os
+import json
+import time
 import struct
 import inspect
-from tracetool import read_events, Event
+import mmap
+import multiprocessing
+from array import array
+from collections import OrderedDict
+from tracetool import read_events, Event, Arguments
 from tracetool.backend.simple import is_string
 
 header_event_id = 0xffffffffffffffff
@@ -23,6 +30,19 @@ record_type_event = 1
 
 log_header_fmt = '=QQQ'
 rec_header_fmt = '=QQII'
+rec_header_len = struct.calcsize(rec_header_fmt)
+
+# Precompiled layouts used by the in-place (mmap) reader
+rectype_struct = struct.Struct('=Q')
+rec_header_struct = struct.Struct('=Q' + rec_header_fmt[1:])
+mapping_struct = struct.Struct('=QQL')
+strlen_struct = struct.Struct('=L')
+
+# Names of the record columns in columnar batches and tables.  C identifiers
+# starting with two underscores are reserved, so they cannot clash with the
+# name of an event argument.
+timestamp_column = '__timestamp'
+pid_column = '__pid'
 
 def read_header(fobj, hfmt):
     '''Read a trace record header'''
@@ -32,38 +52,55 @@ def read_header(fobj, hfmt):
         return None
     return struct.unpack(hfmt, hdr)
 
-def get_record(edict, idtoname, rechdr, fobj):
+def missing_event(name):
+    import sys
+    sys.stderr.write('%s event is logged but is not declared ' \
+                     'in the trace events file, try using ' \
+                     'trace-events-all instead.\n' % repr(name))
+    sys.exit(1)
+
+_shared_tbuf = None
+
+def shared_trace_buffer(edict, idtoname):
+    """Return the TraceBuffer used by get_record() calls without `tbuf`."""
+    global _shared_tbuf
+    if _shared_tbuf is None or _shared_tbuf.edict is not edict or \
+       _shared_tbuf.idtoname is not idtoname:
+        _shared_tbuf = TraceBuffer(edict, idtoname, None)
+    return _shared_tbuf
+
+def get_record(edict, idtoname, rechdr, fobj, tbuf=None):
     """Deserialize a trace record from a file into a tuple
-       (name, timestamp, pid, arg1, ..., arg6)."""
+       (name, timestamp, pid, arg1, ..., arg6).
+
+    The arguments are read at once and decoded by the compiled decoder of
+    the event, see compile_event().  Decoders are cached by event ID in
+    `tbuf`, a TraceBuffer that should be shared by all records of a file
+    and told about mapping records with tbuf.map_event().  Returns None if
+    `tbuf` skips the event or if the record is truncated.
+
+    Without `tbuf`, a buffer kept for `edict` and `idtoname` is used, which
+    follows changes made to `idtoname` directly; a record is always
+    returned and truncated records raise struct.error."""
     if rechdr is None:
         return None
-    if rechdr[0] != dropped_event_id:
-        event_id = rechdr[0]
-        name = idtoname[event_id]
-        rec = (name, rechdr[1], rechdr[3])
-        try:
-            event = edict[name]
-        except KeyError as e:
-            import sys
-            sys.stderr.write('%s event is logged but is not declared ' \
-                             'in the trace events file, try using ' \
-                             'trace-events-all instead.\n' % str(e))
-            sys.exit(1)
-
-        for type, name in event.args:
-            if is_string(type):
-                l = fobj.read(4)
-                (len,) = struct.unpack('=L', l)
-                s = fobj.read(len)
-                rec = rec + (s,)
-            else:
-                (value,) = struct.unpack('=Q', fobj.read(8))
-                rec = rec + (value,)
-    else:
-        rec = ("dropped", rechdr[1], rechdr[3])
-        (value,) = struct.unpack('=Q', fobj.read(8))
-        rec = rec + (value,)
-    return rec
+    shared = tbuf is None
+    if shared:
+        tbuf = shared_trace_buffer(edict, idtoname)
+    entry = tbuf.decoders.get(rechdr[0])
+    if entry is None or \
+       (shared and entry[0] != idtoname.get(rechdr[0], entry[0])):
+        entry = tbuf.decoder(rechdr[0])
+    name, decode = entry
+    size = rechdr[2] - rec_header_len
+    args = fobj.read(size)
+    if len(args) != size:
+        if shared:
+            raise struct.error("truncated trace record")
+        return None
+    if decode is None:
+        return None
+    return (name, rechdr[1], rechdr[3]) + decode(args, 0)
 
 def get_mapping(fobj):
     (event_id, ) = struct.unpack('=Q', fobj.read(8))
@@ -72,10 +109,10 @@ def get_mapping(fobj):
 
     return (event_id, name)
 
-def read_record(edict, idtoname, fobj):
+def read_record(edict, idtoname, fobj, tbuf=None):
     """Deserialize a trace record from a file into a tuple (event_num, timestamp, pid, arg1, ..., arg6)."""
     rechdr = read_header(fobj, rec_header_fmt)
-    return get_record(edict, idtoname, rechdr, fobj)
+    return get_record(edict, idtoname, rechdr, fobj, tbuf)
 
 def read_trace_header(fobj):
     """Read and verify trace file header"""
@@ -96,17 +133,189 @@ def read_trace_header(fobj):
         raise ValueError('Log format %d not supported with this QEMU release!'
                          % log_version)
 
-def read_trace_records(edict, idtoname, fobj):
+def compile_event(event):
+    """Build a decoder for the arguments of a trace event.
+
+    The returned callable takes a buffer and the offset of the first argument
+    of a record and returns the tuple of argument values.  Runs of fixed-width
+    arguments are decoded with a single precompiled struct.Struct, so events
+    without string arguments cost one unpack_from() call.
+    """
+    steps = []
+    nfixed = 0
+    for type, name in event.args:
+        if is_string(type):
+            if nfixed:
+                steps.append(struct.Struct('=' + 'Q' * nfixed))
+                nfixed = 0
+            steps.append(None)
+        else:
+            nfixed += 1
+    if nfixed or not steps:
+        steps.append(struct.Struct('=' + 'Q' * nfixed))
+
+    if len(steps) == 1 and steps[0] is not None:
+        return steps[0].unpack_from
+
+    steps = [(None, 0) if st is None else (st.unpack_from, st.size)
+             for st in steps]
+    unpack_strlen = strlen_struct.unpack_from
+
+    def decode(buf, off):
+        rec = ()
+        for unpack, size in steps:
+            if unpack is None:
+                (slen,) = unpack_strlen(buf, off)
+                off += 4 + slen
+                rec += (buf[off - slen:off],)
+            else:
+                rec += unpack(buf, off)
+                off += size
+        return rec
+    return decode
+
+def map_trace_file(fobj):
+    """Return a read-only mmap of fobj, or None if it cannot be mapped."""
+    try:
+        return mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+        # pipes, in-memory files and empty files cannot be mapped
+        return None
+
+class TraceBuffer(object):
+    """Decoder for trace records held in a buffer, such as an mmap of a
+    trace file.
+
+    Records are decoded in place with precompiled per-event decoders.  The
+    `offset` attribute always points just past the last record consumed by
+    records(), so decoding can be resumed later, e.g. once the buffer grows.
+    Note that `idtoname` is modified if the buffer contains mapping records.
+
+    If `names` is given, records of other events are skipped using the
+    record length without decoding their arguments.
+    """
+
+    def __init__(self, edict, idtoname, buf, offset=0, names=None):
+        self.edict = edict
+        self.idtoname = idtoname
+        self.buf = buf
+        self.offset = offset
+        self.names = names
+        # event name -> argument decoder
+        self.compiled = {}
+        self.clear_decoders()
+
+    def clear_decoders(self):
+        """Forget the decoders bound to event IDs."""
+        # event ID -> (name, argument decoder or None to skip the record)
+        if self.names is None or "dropped" in self.names:
+            self.decoders = {dropped_event_id: ("dropped",
+                                                rectype_struct.unpack_from)}
+        else:
+            self.decoders = {dropped_event_id: ("dropped", None)}
+
+    def decoder(self, event_id):
+        """Look up (and cache) the name and decoder for an event ID."""
+        name = self.idtoname[event_id]
+        if self.names is not None and name not in self.names:
+            decode = None
+        else:
+            decode = self.compiled.get(name)
+            if decode is None:
+                if name not in self.edict:
+                    missing_event(name)
+                decode = self.compiled[name] = compile_event(self.edict[name])
+        self.decoders[event_id] = (name, decode)
+        return name, decode
+
+    def seek(self, offset, idtoname=None):
+        """Continue decoding at offset, optionally with another ID mapping."""
+        self.offset = offset
+        if idtoname is not None:
+            self.idtoname = idtoname
+            self.clear_decoders()
+
+    def map_event(self, event_id, name):
+        """Bind an event ID to an event name."""
+        self.idtoname[event_id] = name
+        self.decoders.pop(event_id, None)
+
+    def records(self, end=None):
+        """Yield record tuples (name, timestamp, pid, arg1, ..., arg6).
+
+        Decoding stops at `end` (by default the end of the buffer) or at the
+        first record that is not completely contained in the buffer.
+        """
+        buf = self.buf
+        off = self.offset
+        if end is None:
+            end = len(buf)
+        decoders = self.decoders
+        unpack_header = rec_header_struct.unpack_from
+        while True:
+            if off + 32 <= end:
+                rectype, event_id, timestamp, length, pid = \
+                    unpack_header(buf, off)
+            elif off + 8 <= end:
+                # only a short mapping record can still fit
+                (rectype,) = rectype_struct.unpack_from(buf, off)
+                if rectype != record_type_mapping:
+                    break
+            else:
+                break
+
+            if rectype == record_type_mapping:
+                if off + 20 > end:
+                    break
+                _, event_id, nlen = mapping_struct.unpack_from(buf, off)
+                if off + 20 + nlen > end:
+                    break
+                self.map_event(event_id,
+                               buf[off + 20:off + 20 + nlen].decode())
+                off += 20 + nlen
+                self.offset = off
+                continue
+
+            if off + 8 + length > end:
+                break
+            try:
+                name, decode = decoders[event_id]
+            except KeyError:
+                name, decode = self.decoder(event_id)
+            off += 8 + length
+            self.offset = off
+            if decode is not None:
+                yield (name, timestamp, pid) + decode(buf, off - length + 24)
+
+def read_trace_records(edict, idtoname, fobj, names=None):
     """Deserialize trace records from a file, yielding record tuples (event_num, timestamp, pid, arg1, ..., arg6).
 
     Note that `idtoname` is modified if the file contains mapping records.
 
+    Regular files are mapped into memory and decoded in place, other file
+    objects are read sequentially.
+
     Args:
         edict (str -> Event): events dict, indexed by name
         idtoname (int -> str): event names dict, indexed by event ID
         fobj (file): input file
+        names (container of str): if given, only records of these events
+                                  are decoded, the others are skipped
 
     """
+    buf = map_trace_file(fobj)
+    if buf is not None:
+        tbuf = TraceBuffer(edict, idtoname, buf, fobj.tell(), names)
+        try:
+            for rec in tbuf.records():
+                yield rec
+        finally:
+            fobj.seek(tbuf.offset)
+            buf.close()
+        return
+
+    # only the decoder cache of tbuf is used
+    tbuf = TraceBuffer(edict, idtoname, None, names=names)
     while True:
         t = fobj.read(8)
         if len(t) == 0:
@@ -115,12 +324,512 @@ def read_trace_records(edict, idtoname, fobj):
         (rectype, ) = struct.unpack('=Q', t)
         if rectype == record_type_mapping:
             event_id, name = get_mapping(fobj)
-            idtoname[event_id] = name
+            tbuf.map_event(event_id, name)
         else:
-            rec = read_record(edict, idtoname, fobj)
+            rec = read_record(edict, idtoname, fobj, tbuf)
+            if rec is not None:
+                yield rec
+
+def index_trace(buf, offset=0, idtoname=None, interval=4096):
+    """Build a record-offset index over a trace buffer.
+
+    Only record headers are read; arguments are skipped using the record
+    length.  Returns a list of checkpoints (offset, idtoname, first, last,
+    counts), one at least every `interval` event records.  Each checkpoint
+    describes the records up to the next one: `idtoname` is the event ID
+    mapping in effect for them, `first` and `last` are their lowest and
+    highest timestamps and `counts` maps event IDs to the number of records.
+    A new checkpoint is started whenever a mapping record rebinds an ID, and
+    the final checkpoint marks the end of the last complete record.
+    Checkpoints share mapping dicts until a mapping record changes them.
+    """
+    idtoname = dict(idtoname or {})
+    checkpoints = []
+    end = len(buf)
+    unpack_rectype = rectype_struct.unpack_from
+    unpack_header = rec_header_struct.unpack_from
+    start = offset
+    first = last = None
+    counts = {}
+    count = 0
+    while offset + 8 <= end:
+        (rectype,) = unpack_rectype(buf, offset)
+        if rectype == record_type_mapping:
+            if offset + 20 > end:
+                break
+            _, event_id, nlen = mapping_struct.unpack_from(buf, offset)
+            if offset + 20 + nlen > end:
+                break
+            if count:
+                checkpoints.append((start, idtoname, first, last, counts))
+                first = last = None
+                counts = {}
+                count = 0
+            idtoname = dict(idtoname)
+            idtoname[event_id] = buf[offset + 20:offset + 20 + nlen].decode()
+            offset += 20 + nlen
+            start = offset
+            continue
+
+        if offset + 32 > end:
+            break
+        _, event_id, timestamp, length, _ = unpack_header(buf, offset)
+        if offset + 8 + length > end:
+            break
+        offset += 8 + length
+        if first is None:
+            first = last = timestamp
+        elif timestamp < first:
+            first = timestamp
+        elif timestamp > last:
+            last = timestamp
+        counts[event_id] = counts.get(event_id, 0) + 1
+        count += 1
+        if count == interval:
+            checkpoints.append((start, idtoname, first, last, counts))
+            start = offset
+            first = last = None
+            counts = {}
+            count = 0
+    if count:
+        checkpoints.append((start, idtoname, first, last, counts))
+    checkpoints.append((offset, idtoname, None, None, {}))
+    return checkpoints
+
+def index_filename(filename):
+    """Return the name of the sidecar index file of a trace file."""
+    return filename + '.idx'
 
+def save_index(filename, checkpoints, interval):
+    """Write the sidecar index of a trace file.
+
+    The size and modification time of the trace file are recorded so that
+    load_index() can detect a stale index.
+    """
+    st = os.stat(filename)
+    mappings = []
+    entries = []
+    for offset, idtoname, first, last, counts in checkpoints:
+        if not mappings or mappings[-1] is not idtoname:
+            mappings.append(idtoname)
+        entries.append([offset, len(mappings) - 1, first, last,
+                        [[k, v] for k, v in counts.items()]])
+    index = {
+        'version': 1,
+        'size': st.st_size,
+        'mtime': st.st_mtime_ns,
+        'interval': interval,
+        'mappings': [[[k, v] for k, v in m.items()] for m in mappings],
+        'checkpoints': entries,
+    }
+    with open(index_filename(filename), 'w') as fobj:
+        json.dump(index, fobj, separators=(',', ':'))
+
+def load_index(filename, interval=4096, save=True, read_header=True):
+    """Return the index checkpoints of a trace file, see index_trace().
+
+    The sidecar index is reused if it matches the size and modification time
+    of the trace file, otherwise the trace is indexed again and, if `save` is
+    true, the sidecar index is rewritten.  ID mappings only contain those
+    found in the trace file itself.  If `read_header` is false the file has
+    no trace header and records start at offset 0.
+    """
+    st = os.stat(filename)
+    with open(filename, 'rb') as fobj:
+        if read_header:
+            read_trace_header(fobj)
+        records_start = fobj.tell()
+    try:
+        with open(index_filename(filename), 'r') as fobj:
+            index = json.load(fobj)
+        if (index['version'] == 1 and index['size'] == st.st_size and
+            index['mtime'] == st.st_mtime_ns and
+            index['interval'] == interval and
+            index['checkpoints'][0][0] == records_start):
+            mappings = [dict(m) for m in index['mappings']]
+            return [(offset, mappings[m], first, last, dict(counts))
+                    for offset, m, first, last, counts
+                    in index['checkpoints']]
+    except (OSError, ValueError, KeyError, TypeError, IndexError):
+        pass
+
+    with open(filename, 'rb') as fobj:
+        fobj.seek(records_start)
+        buf = map_trace_file(fobj)
+        if buf is None:
+            return [(fobj.tell(), {}, None, None, {})]
+        try:
+            checkpoints = index_trace(buf, fobj.tell(), interval=interval)
+        finally:
+            buf.close()
+    if save:
+        try:
+            save_index(filename, checkpoints, interval)
+        except OSError:
+            pass
+    return checkpoints
+
+def read_trace_window(edict, idtoname, fobj, start=None, stop=None,
+                      names=None):
+    """Deserialize the trace records of a file with a timestamp in the range
+    [start, stop) and, if `names` is given, of one of those events.
+
+    The sidecar index of the file is used to skip parts of the trace that
+    contain no matching record, see load_index().  Files without a name or
+    that cannot be mapped are filtered record by record.
+
+    Args:
+        edict (str -> Event): events dict, indexed by name
+        idtoname (int -> str): base event names dict, indexed by event ID
+        fobj (file): input file, positioned after the trace header
+        start (int): lowest timestamp, or None
+        stop (int): timestamp past the end of the range, or None
+        names (container of str): event names, or None
+
+    """
+    def match(rec):
+        return ((start is None or rec[1] >= start) and
+                (stop is None or rec[1] < stop) and
+                (names is None or rec[0] in names))
+
+    if not isinstance(getattr(fobj, 'name', None), str):
+        buf = None
+    else:
+        buf = map_trace_file(fobj)
+    if buf is None:
+        for rec in read_trace_records(edict, idtoname, fobj):
+            if match(rec):
+                yield rec
+        return
+
+    try:
+        # a file positioned at offset 0 was opened without reading a header
+        checkpoints = load_index(fobj.name, read_header=fobj.tell() != 0)
+        tbuf = TraceBuffer(edict, idtoname, buf, names=names)
+        for (offset, mapping, first, last, counts), (end, _, _, _, _) in \
+                zip(checkpoints, checkpoints[1:]):
+            if not counts:
+                continue
+            if start is not None and last < start:
+                continue
+            if stop is not None and first >= stop:
+                continue
+            ids = dict(idtoname)
+            ids.update(mapping)
+            if names is not None and \
+               not any(ids.get(event_id) in names for event_id in counts):
+                continue
+            tbuf.seek(offset, ids)
+            for rec in tbuf.records(end):
+                if match(rec):
+                    yield rec
+    finally:
+        buf.close()
+
+def follow_trace_records(edict, idtoname, fobj, poll_interval=0.1,
+                         idle_timeout=None, chunk_size=1 << 20, names=None):
+    """Deserialize trace records from a file that is still being written,
+    yielding record tuples as they become available.
+
+    The trace file is polled every `poll_interval` seconds once all data
+    written so far has been consumed.  A record that has only been partially
+    flushed is kept until the rest of it is available.  Iteration stops after
+    `idle_timeout` seconds without new data, or never if it is None.
+
+    Note that `idtoname` is modified if the file contains mapping records.
+
+    Args:
+        edict (str -> Event): events dict, indexed by name
+        idtoname (int -> str): event names dict, indexed by event ID
+        fobj (file): input file, positioned after the trace header
+        poll_interval (float): seconds to wait at the end of the file
+        idle_timeout (float): seconds without new data before stopping
+        chunk_size (int): maximum number of bytes read at once
+        names (container of str): if given, only records of these events
+                                  are decoded, the others are skipped
+
+    """
+    tbuf = TraceBuffer(edict, idtoname, b'', names=names)
+    idle_since = time.time()
+    while True:
+        data = fobj.read(chunk_size)
+        if not data:
+            if idle_timeout is not None and \
+               time.time() - idle_since >= idle_timeout:
+                break
+            time.sleep(poll_interval)
+            continue
+        idle_since = time.time()
+        tbuf.buf = tbuf.buf[tbuf.offset:] + data
+        tbuf.seek(0)
+        for rec in tbuf.records():
             yield rec
 
+def wait_trace_header(fobj, poll_interval=0.1):
+    """Wait until the trace file header has been written, then verify it."""
+    while os.fstat(fobj.fileno()).st_size < struct.calcsize(log_header_fmt):
+        time.sleep(poll_interval)
+    read_trace_header(fobj)
+
+def read_trace_batches(edict, idtoname, fobj, batch_size=65536):
+    """Deserialize trace records from a file into columnar batches.
+
+    Yields dicts indexed by event name, each holding a dict of columns
+    (`timestamp_column`, `pid_column` and one column per event argument,
+    named after the argument) for at most `batch_size` records.  Integer
+    columns are array('Q') instances, string columns are lists of bytes.
+
+    Args:
+        edict (str -> Event): events dict, indexed by name
+        idtoname (int -> str): event names dict, indexed by event ID
+        fobj (file): input file
+        batch_size (int): maximum number of records per batch, or None
+
+    """
+    def new_columns(name):
+        cols = [(timestamp_column, array('Q')), (pid_column, array('Q'))]
+        if name == "dropped" and name not in edict:
+            args = [("uint64_t", "num_events_dropped")]
+        else:
+            args = edict[name].args
+        for type, argname in args:
+            cols.append((argname, [] if is_string(type) else array('Q')))
+        return cols
+
+    batch = {}
+    appenders = {}
+    count = 0
+    for rec in read_trace_records(edict, idtoname, fobj):
+        name = rec[0]
+        try:
+            append = appenders[name]
+        except KeyError:
+            cols = new_columns(name)
+            batch[name] = dict(cols)
+            append = appenders[name] = [col.append for _, col in cols]
+        for fn, value in zip(append, rec[1:]):
+            fn(value)
+        count += 1
+        if count == batch_size:
+            yield batch
+            batch = {}
+            appenders = {}
+            count = 0
+    if batch:
+        yield batch
+
+def read_trace_columns(edict, idtoname, fobj):
+    """Deserialize all trace records from a file into columnar arrays.
+
+    Returns a dict indexed by event name, see read_trace_batches().
+    """
+    for batch in read_trace_batches(edict, idtoname, fobj, batch_size=None):
+        return batch
+    return {}
+
+# C argument type -> (column type, array typecode) for exported tables
+column_types = {
+    'bool': ('uint8', 'B'),
+    'char': ('int8', 'b'),
+    'signed char': ('int8', 'b'),
+    'unsigned char': ('uint8', 'B'),
+    'int8_t': ('int8', 'b'),
+    'uint8_t': ('uint8', 'B'),
+    'short': ('int16', 'h'),
+    'unsigned short': ('uint16', 'H'),
+    'int16_t': ('int16', 'h'),
+    'uint16_t': ('uint16', 'H'),
+    'int': ('int32', 'i'),
+    'signed': ('int32', 'i'),
+    'unsigned': ('uint32', 'I'),
+    'unsigned int': ('uint32', 'I'),
+    'int32_t': ('int32', 'i'),
+    'uint32_t': ('uint32', 'I'),
+    'long': ('int64', 'q'),
+    'unsigned long': ('uint64', 'Q'),
+    'int64_t': ('int64', 'q'),
+    'uint64_t': ('uint64', 'Q'),
+    'ssize_t': ('int64', 'q'),
+    'ptrdiff_t': ('int64', 'q'),
+}
+
+def column_type(arg_type):
+    """Return the (column type, array typecode) of an event argument.
+
+    Strings are dictionary-encoded as uint32 codes, pointers and other
+    types are stored as uint64.
+    """
+    if is_string(arg_type):
+        return ('string', 'I')
+    if '*' in arg_type:
+        return ('uint64', 'Q')
+    base = ' '.join(t for t in arg_type.split() if t != 'const')
+    return column_types.get(base, ('uint64', 'Q'))
+
+def narrow_column(values, typecode):
+    """Convert an array('Q') of raw trace values to another typecode.
+
+    Signed arguments are sign-extended to 64 bits by the simple backend, so
+    the values are reinterpreted as int64 before narrowing.  Out of range
+    values are truncated like a C cast would.
+    """
+    if typecode == 'Q':
+        return values
+    if typecode in 'bhiq':
+        signed = array('q')
+        signed.frombytes(values.tobytes())
+        values = signed
+    try:
+        return array(typecode, values)
+    except OverflowError:
+        bits = 8 * array(typecode).itemsize
+        mask = (1 << bits) - 1
+        if typecode in 'BHIQ':
+            return array(typecode, [v & mask for v in values])
+        half = 1 << (bits - 1)
+        return array(typecode, [((v + half) & mask) - half for v in values])
+
+def export_columns(edict, idtoname, fobj, dirname, batch_size=65536,
+                   dict_size=None):
+    """Convert the trace records of a file to one columnar table per event.
+
+    Each event gets a subdirectory of `dirname` holding a meta.json file and
+    one <column>.bin file per column in native byte order: `timestamp_column`
+    and `pid_column` as uint64, then one column per event argument typed
+    according to its C type (see column_type()).  String arguments are
+    dictionary-encoded: <column>.bin holds uint32 codes and <column>.dict
+    the distinct strings as (uint32 length, bytes) entries in code order.
+
+    If `dict_size` is set, at most that many distinct strings per column are
+    kept in memory.  When the limit is reached the in-memory dictionary is
+    restarted and new codes are handed out from where it stopped, so a
+    string may get one code per restart.  The first code of each restart is
+    listed in the 'dict_resets' entry of the column in meta.json, and
+    load_columns() gives equal strings a single code again.
+
+    The trace is converted in batches of `batch_size` records and appended
+    to the tables, so memory usage does not depend on the trace size.
+    Returns a dict of row counts indexed by event name.
+    """
+    import sys
+    tables = {}
+    for batch in read_trace_batches(edict, idtoname, fobj, batch_size):
+        for name, cols in batch.items():
+            table = tables.get(name)
+            if table is None:
+                if name == "dropped" and name not in edict:
+                    args = [("uint64_t", "num_events_dropped")]
+                else:
+                    args = edict[name].args
+                coltypes = [(timestamp_column, ('uint64', 'Q')),
+                            (pid_column, ('uint64', 'Q'))]
+                coltypes += [(argname, column_type(type))
+                             for type, argname in args]
+                table = tables[name] = {
+                    'path': os.path.join(dirname, name),
+                    'rows': 0,
+                    'columns': coltypes,
+                    # column name -> [strdict, next code, restart codes]
+                    'dicts': dict((colname, [{}, 0, []])
+                                  for colname, (ctype, _) in coltypes
+                                  if ctype == 'string'),
+                }
+                os.makedirs(table['path'], exist_ok=True)
+                for colname, _ in coltypes:
+                    for ext in ('.bin', '.dict'):
+                        fname = os.path.join(table['path'], colname + ext)
+                        if os.path.exists(fname):
+                            os.unlink(fname)
+
+            for colname, (ctype, typecode) in table['columns']:
+                values = cols[colname]
+                fname = os.path.join(table['path'], colname)
+                if ctype == 'string':
+                    state = table['dicts'][colname]
+                    codes = array('I')
+                    new_strings = []
+                    for v in values:
+                        code = state[0].get(v)
+                        if code is None:
+                            if dict_size and len(state[0]) >= dict_size:
+                                state[0] = {}
+                                state[2].append(state[1])
+                            code = state[0][v] = state[1]
+                            state[1] += 1
+                            new_strings.append(v)
+                        codes.append(code)
+                    if new_strings:
+                        with open(fname + '.dict', 'ab') as dictfile:
+                            for v in new_strings:
+                                dictfile.write(strlen_struct.pack(len(v)))
+                                dictfile.write(v)
+                    values = codes
+                else:
+                    values = narrow_column(values, typecode)
+                with open(fname + '.bin', 'ab') as colfile:
+                    values.tofile(colfile)
+            table['rows'] += len(cols[timestamp_column])
+
+    for name, table in tables.items():
+        meta = {
+            'event': name,
+            'rows': table['rows'],
+            'byteorder': sys.byteorder,
+            'columns': [{'name': colname, 'type': ctype,
+                         'typecode': typecode,
+                         'encoding': ('dictionary' if ctype == 'string'
+                                      else 'plain')}
+                        for colname, (ctype, typecode) in table['columns']],
+        }
+        for col in meta['columns']:
+            if col['encoding'] == 'dictionary':
+                col['dict_resets'] = table['dicts'][col['name']][2]
+        with open(os.path.join(table['path'], 'meta.json'), 'w') as metafile:
+            json.dump(meta, metafile, indent=2)
+    return dict((name, table['rows']) for name, table in tables.items())
+
+def load_columns(dirname, name):
+    """Load a table written by export_columns().
+
+    Returns a (columns, dictionaries) pair.  `columns` maps column names to
+    arrays; string columns hold dictionary codes which index the lists of
+    bytes in `dictionaries`, indexed by column name.  Each string has a
+    single code, also in tables exported with a `dict_size` limit.
+    """
+    import sys
+    path = os.path.join(dirname, name)
+    with open(os.path.join(path, 'meta.json'), 'r') as metafile:
+        meta = json.load(metafile)
+    columns = {}
+    dictionaries = {}
+    for col in meta['columns']:
+        fname = os.path.join(path, col['name'])
+        values = array(col['typecode'])
+        with open(fname + '.bin', 'rb') as colfile:
+            values.fromfile(colfile, meta['rows'])
+        if meta['byteorder'] != sys.byteorder:
+            values.byteswap()
+        columns[col['name']] = values
+        if col['encoding'] == 'dictionary':
+            strings = []
+            if os.path.exists(fname + '.dict'):
+                with open(fname + '.dict', 'rb') as dictfile:
+                    data = dictfile.read()
+                off = 0
+                while off < len(data):
+                    (slen,) = strlen_struct.unpack_from(data, off)
+                    strings.append(data[off + 4:off + 4 + slen])
+                    off += 4 + slen
+            if col.get('dict_resets'):
+                # merge the codes handed out again after each restart
+                codes = {}
+                remap = array('I', [codes.setdefault(v, len(codes))
+                                    for v in strings])
+                strings = list(codes)
+                columns[col['name']] = array('I', [remap[c] for c in values])
+            dictionaries[col['name']] = strings
+    return columns, dictionaries
+
 class Analyzer(object):
     """A trace file analyzer which processes trace records.
 
@@ -150,8 +859,19 @@ class Analyzer(object):
 
       def runstate_set(self, timestamp, pid, new_state):
           ...
+
+    Analyzers that set `mergeable` to True and implement merge() can be run
+    on several parts of a trace in parallel, see process_parallel().  The
+    copies running on a part have `shard` set to True, so that state only
+    needed by merge() can be skipped in serial runs.
+
+    Analyzers that override catchall() receive the records of all events,
+    unless they set `catchall_events` to the names of the events they need.
     """
 
+    mergeable = False
+    shard = False
+
     def begin(self):
         """Called at the start of the trace."""
         pass
@@ -164,16 +884,21 @@ class Analyzer(object):
         """Called at the end of the trace."""
         pass
 
-def process(events, log, analyzer, read_header=True):
-    """Invoke an analyzer on each event in a log."""
-    if isinstance(events, str):
-        events = read_events(open(events, 'r'), events)
-    if isinstance(log, str):
-        log = open(log, 'rb')
+    def merge(self, other):
+        """Fold the results of another analyzer into this one.
 
-    if read_header:
-        read_trace_header(log)
+        Used by process_parallel(), which runs a copy of this analyzer on
+        each part of the trace and merges the copies back in trace order
+        before end() is invoked.  Records of a part are never seen by the
+        analyzer of another part, so state carried from one record to the
+        next (e.g. a lock acquire and its release) must be reconciled here.
+
+        Only called if `mergeable` is True.
+        """
+        pass
 
+def build_tables(events, read_header=True):
+    """Build the (edict, idtoname) pair used to decode records."""
     dropped_event = Event.build("Dropped_Event(uint64_t num_events_dropped)")
     edict = {"dropped": dropped_event}
     idtoname = {dropped_event_id: "dropped"}
@@ -185,7 +910,23 @@ def process(events, log, analyzer, read_header=True):
     if not read_header:
         for event_id, event in enumerate(events):
             idtoname[event_id] = event.name
+    return edict, idtoname
+
+def wanted_events(analyzer, edict):
+    """Return the names of the events an analyzer handles, or None if it
+    handles all of them.
+
+    Records of other events would only be passed to a catchall() that does
+    nothing, so their arguments need not be decoded at all.
+    """
+    if type(analyzer).catchall is not Analyzer.catchall:
+        names = getattr(analyzer, 'catchall_events', None)
+        return None if names is None else set(names)
+    return set(key for key, event in edict.items()
+               if getattr(analyzer, event.name, None) is not None)
 
+def analyze_records(analyzer, edict, records):
+    """Dispatch trace records to the methods of an analyzer."""
     def build_fn(analyzer, event):
         if isinstance(event, str):
             return analyzer.catchall
@@ -195,7 +936,7 @@ def process(events, log, analyzer, read_header=True):
             return analyzer.catchall
 
         event_argcount = len(event.args)
-        fn_argcount = len(inspect.getargspec(fn)[0]) - 1
+        fn_argcount = len(inspect.getfullargspec(fn)[0]) - 1
         if fn_argcount == event_argcount + 1:
             # Include timestamp as first argument
             return lambda _, rec: fn(*(rec[1:2] + rec[3:3 + event_argcount]))
@@ -206,16 +947,371 @@ def process(events, log, analyzer, read_header=True):
             # Just arguments, no timestamp or pid
             return lambda _, rec: fn(*rec[3:3 + event_argcount])
 
-    analyzer.begin()
     fn_cache = {}
-    for rec in read_trace_records(edict, idtoname, log):
+    for rec in records:
         event_num = rec[0]
         event = edict[event_num]
         if event_num not in fn_cache:
             fn_cache[event_num] = build_fn(analyzer, event)
         fn_cache[event_num](event, rec)
+
+def process(events, log, analyzer, read_header=True, start=None, stop=None,
+            names=None, follow=False):
+    """Invoke an analyzer on each event in a log.
+
+    If any of `start`, `stop` or `names` is given, only the records selected
+    by read_trace_window() are processed.
+
+    If `follow` is true, records are processed as they are appended to the
+    log by a running QEMU, see follow_trace_records(), until the analysis is
+    interrupted with KeyboardInterrupt; end() is still invoked."""
+    if isinstance(events, str):
+        events = read_events(open(events, 'r'), events)
+    if isinstance(log, str):
+        log = open(log, 'rb')
+
+    if read_header and follow:
+        wait_trace_header(log)
+    elif read_header:
+        read_trace_header(log)
+
+    edict, idtoname = build_tables(events, read_header)
+    wanted = wanted_events(analyzer, edict)
+
+    if follow:
+        records = follow_trace_records(edict, idtoname, log, names=wanted)
+    elif start is None and stop is None and names is None:
+        records = read_trace_records(edict, idtoname, log, names=wanted)
+    else:
+        if wanted is not None:
+            names = wanted if names is None else set(names) & wanted
+        records = read_trace_window(edict, idtoname, log, start, stop, names)
+
+    analyzer.begin()
+    try:
+        analyze_records(analyzer, edict, records)
+    except KeyboardInterrupt:
+        if not follow:
+            raise
+    analyzer.end()
+
+def process_shard(shard):
+    """Run an analyzer over the records of one part of a trace file.
+
+    This is the worker side of process_parallel().  Event objects are passed
+    as (key, name, properties, fmt, args) tuples since they cannot be
+    pickled.
+    """
+    filename, start, end, idtoname, specs, analyzer = shard
+    analyzer.shard = True
+    edict = {}
+    for key, name, props, fmt, args in specs:
+        edict[key] = Event(name, props, fmt, Arguments(args))
+    with open(filename, 'rb') as fobj:
+        buf = map_trace_file(fobj)
+        if buf is None:
+            return analyzer
+        try:
+            tbuf = TraceBuffer(edict, dict(idtoname), buf, start,
+                               wanted_events(analyzer, edict))
+            analyze_records(analyzer, edict, tbuf.records(end))
+        finally:
+            buf.close()
+    return analyzer
+
+def process_parallel(events, log, analyzer, read_header=True, jobs=None,
+                     shards_per_job=4):
+    """Invoke an analyzer on each event in a log using a pool of processes.
+
+    The trace is indexed and split into parts with roughly the same number
+    of records.  A pickled copy of `analyzer` is run on each part (begin()
+    is only invoked on the original), the copies are folded back with
+    analyzer.merge() in trace order and finally analyzer.end() is invoked.
+
+    Analyzers whose `mergeable` attribute is false and traces that cannot be
+    mapped into memory are processed serially with process().
+    """
+    if isinstance(events, str):
+        events = read_events(open(events, 'r'), events)
+    if isinstance(log, str):
+        log = open(log, 'rb')
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+
+    if jobs <= 1 or not analyzer.mergeable:
+        return process(events, log, analyzer, read_header=read_header)
+    buf = map_trace_file(log)
+    if buf is None:
+        return process(events, log, analyzer, read_header=read_header)
+
+    if read_header:
+        read_trace_header(log)
+    edict, idtoname = build_tables(events, read_header)
+    try:
+        checkpoints = index_trace(buf, log.tell(), idtoname)
+    finally:
+        buf.close()
+    # shard boundaries are a subset of the index checkpoints
+    step = max(1, -(-(len(checkpoints) - 1) // (jobs * shards_per_job)))
+    checkpoints = checkpoints[:-1:step] + checkpoints[-1:]
+
+    specs = [(key, event.name, list(event.properties), event.fmt,
+              list(event.args)) for key, event in edict.items()]
+    analyzer.begin()
+    shards = [(log.name, cp[0], next_cp[0], cp[1], specs, analyzer)
+              for cp, next_cp in zip(checkpoints, checkpoints[1:])]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap(process_shard, shards):
+            analyzer.merge(result)
+    finally:
+        pool.close()
+        pool.join()
     analyzer.end()
 
+class LatencyHistogram(object):
+    """Log-bucketed histogram of non-negative integer values.
+
+    Values below 2 ** (sub_bucket_bits + 1) are counted exactly, larger ones
+    in 2 ** sub_bucket_bits linear sub-buckets per power of two, like an HDR
+    histogram.  The relative error of reported values is thus at most
+    2 ** -sub_bucket_bits, and the memory used only grows with the
+    logarithm of the value range.
+    """
+
+    def __init__(self, sub_bucket_bits=7):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def bucket(self, value):
+        """Return the index of the bucket counting value."""
+        shift = value.bit_length() - self.sub_bucket_bits - 1
+        if shift <= 0:
+            return value
+        return (shift << self.sub_bucket_bits) + (value >> shift)
+
+    def bucket_range(self, index):
+        """Return the lowest and highest value counted by a bucket."""
+        shift = (index >> self.sub_bucket_bits) - 1
+        if shift <= 0:
+            return index, index
+        low = (index - (shift << self.sub_bucket_bits)) << shift
+        return low, low + (1 << shift) - 1
+
+    def record(self, value, count=1):
+        """Count a value."""
+        index = self.bucket(value)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += count
+        self.total += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add the counts of another histogram with the same precision."""
+        assert self.sub_bucket_bits == other.sub_bucket_bits
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                if self.min is None or value < self.min:
+                    self.min = value
+                if self.max is None or value > self.max:
+                    self.max = value
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentiles(self, percents):
+        """Return the values at the given percentiles (0-100).
+
+        Each value is the upper bound of the bucket holding the matching
+        rank, capped at the largest recorded value.
+        """
+        for p in percents:
+            if not 0 <= p <= 100:
+                raise ValueError("percentile %s is not between 0 and 100" % p)
+        if not self.count:
+            return [None] * len(percents)
+        ranks = [max(1, -(-self.count * p // 100)) for p in percents]
+        order = sorted(range(len(ranks)), key=lambda i: ranks[i])
+        result = [None] * len(ranks)
+        seen = 0
+        indices = iter(sorted(self.buckets))
+        index = None
+        for i in order:
+            while seen < ranks[i]:
+                index = next(indices)
+                seen += self.buckets[index]
+            result[i] = min(self.bucket_range(index)[1], self.max)
+        return result
+
+class LatencyAnalyzer(Analyzer):
+    """Measure the time between matching begin and end events.
+
+    A begin record is matched with the next end record from the same
+    process whose `end_key` argument equals the `begin_key` argument of the
+    begin record, e.g. a request submission and its completion keyed by the
+    request pointer.  Latencies are collected in a LatencyHistogram,
+    overall and, if `group` is true, per key value.
+
+    At most `max_pending` begin records are kept waiting for their end, the
+    oldest ones are dropped (and counted in `evicted`) beyond that.  At most
+    `max_groups` key values get their own histogram; latencies of further
+    keys only go to the overall one and are counted in `ungrouped`.  End
+    records without a begin are counted in `unmatched`.  Records are
+    dispatched through catchall() with `catchall_events` set, so other
+    events are not decoded.
+    """
+
+    mergeable = True
+
+    def __init__(self, begin_event, end_event, begin_key, end_key=None,
+                 group=False, max_pending=1 << 20, sub_bucket_bits=7,
+                 max_groups=1 << 16):
+        self.begin_event = begin_event
+        self.end_event = end_event
+        self.begin_key = begin_key
+        self.end_key = end_key or begin_key
+        self.group = group
+        self.max_pending = max_pending
+        self.max_groups = max_groups
+        self.sub_bucket_bits = sub_bucket_bits
+        self.catchall_events = set([begin_event, end_event])
+        self.begin()
+
+    def begin(self):
+        self.histogram = LatencyHistogram(self.sub_bucket_bits)
+        self.groups = {}
+        # (pid, key) -> begin timestamp, oldest first
+        self.pending = OrderedDict()
+        # (pid, key) -> timestamp of an end record seen before any begin
+        # record for that key, which may match a begin record pending at
+        # the end of an earlier part of the trace, or None if a begin record
+        # came first.  Only kept when running on a part of the trace.
+        self.leading_ends = {}
+        self.unmatched = 0
+        self.evicted = 0
+        self.ungrouped = 0
+        self.key_index = {}
+
+    def key_position(self, event):
+        """Return the record index of the key argument of an event."""
+        name = self.begin_key if event.name == self.begin_event \
+            else self.end_key
+        names = event.args.names()
+        if name not in names:
+            raise ValueError("event %s has no argument %s" %
+                             (event.name, name))
+        return 3 + names.index(name)
+
+    def record(self, key, latency):
+        self.histogram.record(latency)
+        if self.group:
+            histogram = self.groups.get(key[1])
+            if histogram is None:
+                if len(self.groups) >= self.max_groups:
+                    self.ungrouped += 1
+                    return
+                histogram = self.groups[key[1]] = \
+                    LatencyHistogram(self.sub_bucket_bits)
+            histogram.record(latency)
+
+    def catchall(self, event, rec):
+        try:
+            index = self.key_index[event.name]
+        except KeyError:
+            index = self.key_index[event.name] = self.key_position(event)
+        key = (rec[2], rec[index])
+        if event.name == self.begin_event:
+            self.pending.pop(key, None)
+            self.pending[key] = rec[1]
+            if len(self.pending) > self.max_pending:
+                self.pending.popitem(last=False)
+                self.evicted += 1
+            self.leading_end(key, None)
+        else:
+            start = self.pending.pop(key, None)
+            if start is not None:
+                self.record(key, rec[1] - start)
+            elif not self.leading_end(key, rec[1]):
+                self.unmatched += 1
+
+    def leading_end(self, key, timestamp):
+        """Remember the first record seen for a key, if there is room."""
+        if not self.shard or key in self.leading_ends or \
+           len(self.leading_ends) >= self.max_pending:
+            return False
+        self.leading_ends[key] = timestamp
+        return True
+
+    def merge(self, other):
+        for key, timestamp in other.leading_ends.items():
+            if timestamp is None:
+                # a begin record in other replaced the one pending here
+                self.pending.pop(key, None)
+                self.leading_end(key, None)
+                continue
+            start = self.pending.pop(key, None)
+            if start is not None:
+                self.record(key, timestamp - start)
+            elif not self.leading_end(key, timestamp):
+                self.unmatched += 1
+        for key, timestamp in other.pending.items():
+            self.pending.pop(key, None)
+            self.pending[key] = timestamp
+        while len(self.pending) > self.max_pending:
+            self.pending.popitem(last=False)
+            self.evicted += 1
+        self.histogram.merge(other.histogram)
+        for key, histogram in other.groups.items():
+            if key in self.groups:
+                self.groups[key].merge(histogram)
+            elif len(self.groups) < self.max_groups:
+                self.groups[key] = histogram
+            else:
+                self.ungrouped += histogram.count
+        self.unmatched += other.unmatched
+        self.evicted += other.evicted
+        self.ungrouped += other.ungrouped
+
+    def report(self, percents=(50, 90, 99, 99.9)):
+        """Return a list of text lines with the latency statistics."""
+        lines = ['pairs: %d, unmatched %s: %d, unfinished %s: %d, '
+                 'evicted: %d' % (self.histogram.count, self.end_event,
+                                  self.unmatched + sum(
+                                      1 for t in self.leading_ends.values()
+                                      if t is not None),
+                                  self.begin_event, len(self.pending),
+                                  self.evicted)]
+        if self.ungrouped:
+            lines[0] += ', ungrouped: %d' % self.ungrouped
+        header = ['group', 'count', 'min', 'mean'] + \
+                 ['p%s' % p for p in percents] + ['max']
+        lines.append(' '.join('%14s' % h for h in header))
+        groups = [('all', self.histogram)]
+        groups += sorted(self.groups.items(), key=lambda item: item[0])
+        for key, histogram in groups:
+            if not histogram.count:
+                continue
+            if isinstance(key, int):
+                key = '0x%x' % key
+            elif isinstance(key, bytes):
+                key = key.decode(errors='replace')
+            fields = [key, histogram.count, histogram.min,
+                      '%.1f' % histogram.mean()]
+            fields += histogram.percentiles(percents) + [histogram.max]
+            lines.append(' '.join('%14s' % f for f in fields))
+        return lines
+
 def run(analyzer):
     """Execute an analyzer on a trace file given on the command-line.
 
@@ -224,16 +1320,39 @@ def run(analyzer):
     import sys
 
     read_header = True
-    if len(sys.argv) == 4 and sys.argv[1] == '--no-header':
-        read_header = False
+    jobs = 1
+    window = {}
+    follow = False
+    while len(sys.argv) > 3 and sys.argv[1].startswith('--'):
+        opt, _, value = sys.argv[1].partition('=')
+        if opt == '--no-header' and not value:
+            read_header = False
+        elif opt == '--follow' and not value:
+            follow = True
+        elif opt == '--jobs' and value.isdigit():
+            jobs = int(value)
+        elif opt in ('--start', '--stop') and value.isdigit():
+            window[opt[2:]] = int(value)
+        elif opt == '--events' and value:
+            window['names'] = set(value.split(','))
+        else:
+            break
         del sys.argv[1]
-    elif len(sys.argv) != 3:
-        sys.stderr.write('usage: %s [--no-header] <trace-events> ' \
-                         '<trace-file>\n' % sys.argv[0])
+    if len(sys.argv) != 3 or (window and (follow or not read_header)):
+        sys.stderr.write('usage: %s [--no-header] [--follow] [--jobs=N] ' \
+                         '[--start=NS] [--stop=NS] [--events=NAME,...] ' \
+                         '<trace-events> <trace-file>\n' % sys.argv[0])
         sys.exit(1)
 
     events = read_events(open(sys.argv[1], 'r'), sys.argv[1])
-    process(events, sys.argv[2], analyzer, read_header=read_header)
+    if follow:
+        process(events, sys.argv[2], analyzer, read_header=read_header,
+                follow=True)
+    elif window:
+        process(events, sys.argv[2], analyzer, **window)
+    else:
+        process_parallel(events, sys.argv[2], analyzer,
+                         read_header=read_header, jobs=jobs)
 
 if __name__ == '__main__':
     class Formatter(Analyzer):
@@ -15,8 +15,10 @@ __email__      = "stefanha@linux.vnet.ibm.com"
 
 import sys
 import getopt
+import io
+import os
 
-from tracetool import error_write, out
+from tracetool import error_write, error, out
 import tracetool.backend
 import tracetool.format
 
@@ -33,6 +35,7 @@ def error_opt(msg = None):
                                for n,d in tracetool.format.get_list() ])
     error_write("""\
 Usage: %(script)s --format=<format> --backends=<backends> [<options>]
+       %(script)s --batch=<manifest> [<options>]
 
 Backends:
 %(backends)s
@@ -49,7 +52,12 @@ Options:
     --target-name <name>     QEMU emulator target name.
     --group <name>           Name of the event group
     --probe-prefix <prefix>  Prefix for dtrace probe names
-                             (default: qemu-<target-type>-<target-name>).\
+                             (default: qemu-<target-type>-<target-name>).
+    --batch <manifest>       Generate the outputs listed in <manifest>, one
+                             per line as
+                             <group> <format> <backends> <output> <input>...
+                             Each input is parsed once and outputs are only
+                             rewritten if their contents change.\
 """ % {
             "script" : _SCRIPT,
             "backends" : backend_descr,
@@ -61,12 +69,56 @@ Options:
     else:
         sys.exit(1)
 
+def write_if_changed(filename, contents):
+    try:
+        with open(filename, "r") as fh:
+            if fh.read() == contents:
+                return False
+    except (OSError, UnicodeDecodeError):
+        pass
+    tmp = filename + ".tmp"
+    with open(tmp, "w") as fh:
+        fh.write(contents)
+    os.replace(tmp, filename)
+    return True
+
+def run_batch(manifest, binary, probe_prefix):
+    events_by_file = {}
+    with open(manifest, "r") as fh:
+        jobs = [line.split() for line in fh
+                if line.strip() and not line.lstrip().startswith("#")]
+    for job in jobs:
+        if len(job) < 5:
+            error("%s: malformed job: %s" % (manifest, " ".join(job)))
+        group, format, backends, output = job[:4]
+        if format == "stap" and (binary is None or probe_prefix is None):
+            error("%s: --binary and --probe-prefix (or --target-type and "
+                  "--target-name) are required for SystemTAP tapset "
+                  "generator" % output)
+        events = []
+        for filename in job[4:]:
+            if filename not in events_by_file:
+                with open(filename, "r") as fh:
+                    events_by_file[filename] = tracetool.read_events(fh, filename)
+            events.extend(events_by_file[filename])
+
+        tracetool.out_fobj = io.StringIO()
+        try:
+            tracetool.generate(events, group, format, backends.split(","),
+                               binary=binary, probe_prefix=probe_prefix)
+        except tracetool.TracetoolError as e:
+            error("%s: %s" % (output, e))
+        finally:
+            contents = tracetool.out_fobj.getvalue()
+            tracetool.out_fobj = None
+        write_if_changed(output, contents)
+
 def main(args):
     global _SCRIPT
     _SCRIPT = args[0]
 
     long_opts = ["backends=", "format=", "help", "list-backends",
-                 "check-backends", "group="]
+                 "check-backends", "group=", "batch="]
     long_opts += ["binary=", "target-type=", "target-name=", "probe-prefix="]
 
     try:
@@ -78,6 +130,7 @@ def main(args):
     arg_backends = []
     arg_format = ""
     arg_group = None
+    arg_batch = None
     binary = None
     target_type = None
     target_name = None
@@ -92,6 +145,8 @@ def main(args):
             arg_group = arg
         elif opt == "--format":
             arg_format = arg
+        elif opt == "--batch":
+            arg_batch = arg
 
         elif opt == "--list-backends":
             public_backends = tracetool.backend.get_list(only_public = True)
@@ -112,6 +167,14 @@ def main(args):
         else:
             error_opt("unhandled option: %s" % opt)
 
+    if probe_prefix is None and target_type is not None and \
+       target_name is not None:
+        probe_prefix = ".".join(["qemu", target_type, target_name])
+
+    if arg_batch is not None:
+        run_batch(arg_batch, binary, probe_prefix)
+        sys.exit(0)
+
     if len(arg_backends) == 0:
         error_opt("no backends specified")
 
@@ -132,9 +195,6 @@ def main(args):
         if probe_prefix is None and target_name is None:
             error_opt("--target-name is required for SystemTAP tapset generator")
 
-        if probe_prefix is None:
-            probe_prefix = ".".join(["qemu", target_type, target_name])
-
     if len(args) < 1:
         error_opt("missing trace-events filepath")
     events = []
@@ -31,14 +31,18 @@ def error(*lines):
     sys.exit(1)
 
 
+out_fobj = None
+
 def out(*lines, **kwargs):
     """Write a set of output lines.
 
     You can use kwargs as a shorthand for mapping variables when formating all
     the strings in lines.
+
+    Lines are written to out_fobj, or to standard output if it is None.
     """
     lines = [ l % kwargs for l in lines ]
-    sys.stdout.writelines("\n".join(lines) + "\n")
+    (out_fobj or sys.stdout).writelines("\n".join(lines) + "\n")
 
 # We only want to allow standard C types or fixed sized
 # integer types. We don't want QEMU specific types
@@ -16,6 +16,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import array
 import atexit
 from collections import OrderedDict
 import faulthandler
@@ -24,6 +25,8 @@ import json
 import logging
 import os
 import re
+import select
+import selectors
 import signal
 import struct
 import subprocess
@@ -210,42 +213,117 @@ def get_virtio_scsi_device():
     return 'virtio-scsi-pci'
 
 class QemuIoInteractive:
+    PROMPT = b'qemu-io> '
+
     def __init__(self, *args):
         self.args = qemu_io_args + list(args)
         self._p = subprocess.Popen(self.args, stdin=subprocess.PIPE,
                                    stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT,
-                                   universal_newlines=True)
-        assert self._p.stdout.read(9) == 'qemu-io> '
+                                   stderr=subprocess.STDOUT)
+        # qemu-io does not frame the output of its commands.  Each command
+        # is followed by one that does not exist, with a name unique to
+        # this session: the error message about it and the next prompt
+        # end the output of the command, whatever that output contains.
+        self._end_cmd = '__iotests_end_%s' % os.urandom(8).hex()
+        self._end = b'command "%s" not found\n' % self._end_cmd.encode() + \
+            self.PROMPT
+        self._buf = bytearray()
+        self._outputs: List[str] = []
+        os.write(self._p.stdin.fileno(), self._end_cmd.encode() + b'\n')
+        while not self._outputs:
+            self._fill()
+        assert self._outputs.pop() == ''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def alive(self) -> bool:
+        '''Return whether the qemu-io process is still running'''
+        return self._p.poll() is None
 
     def close(self):
-        self._p.communicate('q\n')
-
-    def _read_output(self):
-        pattern = 'qemu-io> '
-        n = len(pattern)
-        pos = 0
-        s = []
-        while pos != n:
-            c = self._p.stdout.read(1)
-            # check unexpected EOF
-            assert c != ''
-            s.append(c)
-            if c == pattern[pos]:
-                pos += 1
-            else:
-                pos = 0
+        if self.alive():
+            self._p.communicate(b'q\n')
+
+    def _fill(self):
+        # Split whatever has been read so far on the end marker; the
+        # prompt printed before the end command is not part of the output
+        chunk = os.read(self._p.stdout.fileno(), 65536)
+        # check unexpected EOF
+        assert chunk != b''
+        start = max(0, len(self._buf) - len(self._end) + 1)
+        self._buf += chunk
+        while True:
+            pos = self._buf.find(self._end, start)
+            if pos < 0:
+                break
+            output = self._buf[:pos]
+            assert output.endswith(self.PROMPT)
+            self._outputs.append(output[:-len(self.PROMPT)].decode())
+            del self._buf[:pos + len(self._end)]
+            start = 0
 
-        return ''.join(s[:-n])
+    def cmds(self, cmds: Sequence[str]) -> List[str]:
+        """
+        Send several commands at once and return the output of each.
+        """
+        lines = []
+        for cmd in cmds:
+            # quit command is in close(), '\n' is added automatically
+            assert '\n' not in cmd
+            cmd = cmd.strip()
+            assert cmd not in ('q', 'quit')
+            lines.append('%s\n%s\n' % (cmd, self._end_cmd))
+        data = memoryview(''.join(lines).encode())
+
+        # Keep reading while writing, so that neither side blocks on
+        # a full pipe
+        with selectors.DefaultSelector() as sel:
+            sel.register(self._p.stdout, selectors.EVENT_READ)
+            if data:
+                sel.register(self._p.stdin, selectors.EVENT_WRITE)
+            while len(self._outputs) < len(cmds):
+                for key, _ in sel.select():
+                    if key.fileobj is self._p.stdout:
+                        self._fill()
+                        continue
+                    written = os.write(self._p.stdin.fileno(),
+                                       data[:select.PIPE_BUF])
+                    data = data[written:]
+                    if not data:
+                        sel.unregister(self._p.stdin)
+
+        outputs = self._outputs[:len(cmds)]
+        del self._outputs[:len(cmds)]
+        return outputs
 
     def cmd(self, cmd):
-        # quit command is in close(), '\n' is added automatically
-        assert '\n' not in cmd
-        cmd = cmd.strip()
-        assert cmd not in ('q', 'quit')
-        self._p.stdin.write(cmd + '\n')
-        self._p.stdin.flush()
-        return self._read_output()
+        return self.cmds([cmd])[0]
+
+
+_qemu_io_sessions: Dict[Sequence[str], QemuIoInteractive] = {}
+
+def qemu_io_session(*args):
+    '''Return a qemu-io process for args, started on first use and reused
+       by later calls with the same args until qemu_io_sessions_close().
+       The image stays open, locked and cached in between, so nothing else
+       may access it until the session is closed.'''
+    session = _qemu_io_sessions.get(args)
+    if session is None or not session.alive():
+        session = QemuIoInteractive(*args)
+        _qemu_io_sessions[args] = session
+    return session
+
+def qemu_io_sessions_close():
+    '''Terminate the processes started by qemu_io_session()'''
+    while _qemu_io_sessions:
+        _, session = _qemu_io_sessions.popitem()
+        session.close()
+
+atexit.register(qemu_io_sessions_close)
 
 
 def qemu_nbd(*args):
@@ -276,15 +354,171 @@ def compare_images(img1, img2, fmt1=imgfmt, fmt2=imgfmt):
     return qemu_img('compare', '-f', fmt1,
                     '-F', fmt2, img1, img2) == 0
 
+# Buffer size used when generating image contents
+image_chunk_size = 4 * 1024 * 1024
+
+def sector_markers(first, count):
+    '''Return count sectors starting with sector number first, each
+       beginning and ending with its number as a big-endian 32-bit value'''
+    # Build the sectors as 128 32-bit words each, filling the first and
+    # last word of all sectors with one slice assignment apiece
+    words = array.array('I', bytes(count * 512))
+    numbers = array.array('I', range(first, first + count))
+    if sys.byteorder == 'little':
+        numbers.byteswap()
+    words[0::128] = numbers
+    words[127::128] = numbers
+    return words.tobytes()
+
 def create_image(name, size):
     '''Create a fully-allocated raw image with sector markers'''
-    file = open(name, 'wb')
-    i = 0
-    while i < size:
-        sector = struct.pack('>l504xl', i // 512, i // 512)
-        file.write(sector)
-        i = i + 512
-    file.close()
+    sectors = (size + 511) // 512
+    chunk = image_chunk_size // 512
+    with open(name, 'wb') as file:
+        for first in range(0, sectors, chunk):
+            file.write(sector_markers(first, min(chunk, sectors - first)))
+
+def _write_pattern(fd, offset, length, pattern):
+    '''Write length bytes of pattern (a byte value, as for qemu-io
+       write -P) to fd at offset'''
+    buf = bytes([pattern]) * min(length, image_chunk_size)
+    while length > 0:
+        n = os.pwrite(fd, buf[:length], offset)
+        offset += n
+        length -= n
+
+def create_raw_image(name, size, extents=()):
+    '''Create a sparse raw image of the given size.  extents is a list of
+       (offset, length, pattern) tuples: the ranges to fill with the
+       byte pattern, as "qemu-io -c 'write -P pattern offset length'"
+       would.  The rest of the image is left unallocated.'''
+    with open(name, 'wb') as file:
+        file.truncate(size)
+        for offset, length, pattern in extents:
+            assert offset + length <= size
+            _write_pattern(file.fileno(), offset, length, pattern)
+
+def _qcow2_allocate(size, extents, cluster_size):
+    '''Return the guest clusters touched by extents, grouped by the index
+       of their L2 table and sorted'''
+    l2_entries = cluster_size // 8
+    allocated = set()
+    for offset, length, _ in extents:
+        assert offset + length <= size
+        first = offset // cluster_size
+        end = (offset + length + cluster_size - 1) // cluster_size
+        allocated.update(range(first, end))
+    l2_tables: Dict[int, List[int]] = {}
+    for cluster in sorted(allocated):
+        l2_tables.setdefault(cluster // l2_entries, []).append(cluster)
+    return l2_tables
+
+def _qcow2_layout(size, l2_tables, cluster_size):
+    '''Place the clusters of a qcow2 image: header, refcount table, L1
+       table, then each L2 table followed by its data clusters in guest
+       order, then refcount blocks.  Return the L1 table, the host
+       cluster of each guest cluster, the size of the refcount table and
+       the number of refcount blocks (both in clusters), and the total
+       number of clusters.'''
+    l2_entries = cluster_size // 8
+    refblock_entries = cluster_size // 2
+
+    def clusters(nbytes):
+        return (nbytes + cluster_size - 1) // cluster_size
+
+    l1_size = (clusters(size) + l2_entries - 1) // l2_entries
+    l1_clusters = clusters(l1_size * 8)
+    used = 1 + l1_clusters + len(l2_tables) + \
+        sum(len(c) for c in l2_tables.values())
+
+    # The refcount structures must cover themselves
+    reftable_clusters = refblocks = 1
+    while True:
+        total = used + reftable_clusters + refblocks
+        new_refblocks = (total + refblock_entries - 1) // refblock_entries
+        new_reftable_clusters = clusters(new_refblocks * 8)
+        if (new_refblocks, new_reftable_clusters) == \
+                (refblocks, reftable_clusters):
+            break
+        refblocks, reftable_clusters = new_refblocks, new_reftable_clusters
+
+    next_cluster = 1 + reftable_clusters + l1_clusters
+    l1 = [0] * l1_size
+    host_cluster = {}
+    for l2_index in sorted(l2_tables):
+        l1[l2_index] = next_cluster * cluster_size
+        next_cluster += 1
+        for cluster in l2_tables[l2_index]:
+            host_cluster[cluster] = next_cluster
+            next_cluster += 1
+    assert next_cluster + refblocks == total
+    return l1, host_cluster, reftable_clusters, refblocks, total
+
+def _qcow2_write_metadata(fd, size, cluster_size, l2_tables, layout):
+    '''Write the header and tables of the layout computed by
+       _qcow2_layout()'''
+    l1, host_cluster, reftable_clusters, refblocks, total = layout
+    copied = 1 << 63
+    l2_entries = cluster_size // 8
+    reftable_offset = cluster_size
+    l1_offset = reftable_offset + reftable_clusters * cluster_size
+    refblock_offset = (total - refblocks) * cluster_size
+
+    header = struct.pack('>IIQIIQIIQQIIQQQQII', 0x514649fb, 3, 0, 0,
+                         cluster_size.bit_length() - 1, size, 0, len(l1),
+                         l1_offset, reftable_offset, reftable_clusters, 0, 0,
+                         0, 0, 0, 4, 104)
+    # End of header extensions
+    os.pwrite(fd, header + bytes(8), 0)
+
+    reftable = [refblock_offset + i * cluster_size for i in range(refblocks)]
+    os.pwrite(fd, struct.pack('>%dQ' % refblocks, *reftable),
+              reftable_offset)
+    os.pwrite(fd, struct.pack('>%dQ' % len(l1),
+                              *[e | copied if e else 0 for e in l1]),
+              l1_offset)
+
+    for l2_index, l2_clusters in l2_tables.items():
+        l2 = [0] * l2_entries
+        for cluster in l2_clusters:
+            l2[cluster % l2_entries] = \
+                (host_cluster[cluster] * cluster_size) | copied
+        os.pwrite(fd, struct.pack('>%dQ' % l2_entries, *l2), l1[l2_index])
+
+    # Every cluster is in use once
+    os.pwrite(fd, struct.pack('>H', 1) * total, refblock_offset)
+
+def create_qcow2_image(name, size, extents=(), cluster_size=65536):
+    '''Create a qcow2 (version 3) image of the given size without using
+       qemu-img.  extents is a list of (offset, length, pattern) tuples as
+       for create_raw_image(); every cluster they touch is allocated,
+       unwritten parts of those clusters read as zeroes.  The image has no
+       backing file, snapshots, compression or header extensions, and
+       16-bit refcounts.'''
+    assert cluster_size & (cluster_size - 1) == 0 and \
+        512 <= cluster_size <= 2 * 1024 * 1024
+    l2_entries = cluster_size // 8
+    l2_tables = _qcow2_allocate(size, extents, cluster_size)
+    layout = _qcow2_layout(size, l2_tables, cluster_size)
+    host_cluster, total = layout[1], layout[4]
+
+    with open(name, 'wb') as file:
+        fd = file.fileno()
+        file.truncate(total * cluster_size)
+        _qcow2_write_metadata(fd, size, cluster_size, l2_tables, layout)
+
+        # Data clusters of the same L2 table are contiguous on the host,
+        # so write each extent in one go per L2 table it spans
+        for offset, length, pattern in extents:
+            end = offset + length
+            while offset < end:
+                table_end = (offset // cluster_size // l2_entries + 1) * \
+                    l2_entries * cluster_size
+                n = min(end, table_end) - offset
+                host = host_cluster[offset // cluster_size] * cluster_size + \
+                    offset % cluster_size
+                _write_pattern(fd, host, n, pattern)
+                offset += n
 
 def image_size(img):
     '''Return image's virtual size'''
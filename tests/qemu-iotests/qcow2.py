@@ -3,6 +3,10 @@
 import sys
 import struct
 import string
+import array
+import json
+import mmap
+from collections import OrderedDict
 
 class QcowHeaderExtension:
 
@@ -158,6 +162,484 @@ class QcowHeader:
             print("")
 
 
+QCOW_OFLAG_COPIED     = 1 << 63
+QCOW_OFLAG_COMPRESSED = 1 << 62
+QCOW_OFLAG_ZERO       = 1 << 0
+
+L1E_OFFSET_MASK  = 0x00fffffffffffe00
+L2E_OFFSET_MASK  = 0x00fffffffffffe00
+REFT_OFFSET_MASK = 0xfffffffffffffe00
+BME_TABLE_ENTRY_OFFSET_MASK = 0x00fffffffffffe00
+
+QCOW2_INCOMPAT_DATA_FILE = 1 << 2
+
+QCOW2_EXT_MAGIC_CRYPTO_HEADER = 0x0537be77
+QCOW2_EXT_MAGIC_BITMAPS       = 0x23852875
+
+# Kinds of clusters, as tracked by QcowImage.check()
+ROLES = [ None, 'header', 'refcount table', 'refcount block', 'L1 table',
+          'L2 table', 'data', 'compressed data', 'snapshot table',
+          'bitmap directory', 'bitmap table', 'bitmap data',
+          'crypto header' ]
+(ROLE_HEADER, ROLE_REFTABLE, ROLE_REFBLOCK, ROLE_L1, ROLE_L2, ROLE_DATA,
+ ROLE_COMPRESSED, ROLE_SNAPSHOTS, ROLE_BITMAP_DIR, ROLE_BITMAP_TABLE,
+ ROLE_BITMAP_DATA, ROLE_CRYPTO) = range(1, len(ROLES))
+
+class QcowSnapshot:
+
+    fmt = '>QIHHIIQII'
+
+    def __init__(self, buf, offset):
+        (self.l1_table_offset, self.l1_size, id_str_size, name_size,
+         self.date_sec, self.date_nsec, self.vm_clock_nsec,
+         self.vm_state_size, extra_data_size) = \
+            struct.unpack_from(QcowSnapshot.fmt, buf, offset)
+        offset += struct.calcsize(QcowSnapshot.fmt) + extra_data_size
+        self.id_str = bytes(buf[offset:offset + id_str_size]).decode()
+        offset += id_str_size
+        self.name = bytes(buf[offset:offset + name_size]).decode()
+        offset += name_size
+        self.end = (offset + 7) & ~7
+
+class QcowBitmap:
+
+    fmt = '>QIIBBHI'
+
+    def __init__(self, buf, offset):
+        (self.table_offset, self.table_size, self.flags, self.type,
+         self.granularity_bits, name_size, extra_data_size) = \
+            struct.unpack_from(QcowBitmap.fmt, buf, offset)
+        offset += struct.calcsize(QcowBitmap.fmt) + extra_data_size
+        self.name = bytes(buf[offset:offset + name_size]).decode()
+        self.end = (offset + name_size + 7) & ~7
+
+class QcowCheckResult:
+
+    def __init__(self, references):
+        # expected refcount of every host cluster
+        self.references = references
+        # (cluster, refcount, references) tuples
+        self.leaks = []
+        self.corruptions = []
+        # (cluster, role, other role) tuples
+        self.overlaps = []
+        # (offset, role) of metadata or data beyond the end of the file
+        self.out_of_range = []
+
+    def errors(self):
+        return len(self.corruptions) + len(self.overlaps) + \
+            len(self.out_of_range)
+
+class QcowImage:
+    """
+    Read-only access to the metadata of a qcow2 image.
+
+    The image file is mapped into memory; L1, L2 and refcount tables are
+    decoded into arrays when first used, and recently used L2 tables and
+    refcount blocks are cached.  Runs of L2 entries pointing to
+    consecutive host clusters are handled a whole run at a time, which
+    keeps map() and check() fast on large, mostly contiguous images.
+    Backing files and external data files are not opened.
+    """
+
+    cache_size = 64
+
+    def __init__(self, fd):
+        self.header = QcowHeader(fd)
+        h = self.header
+        self.cluster_size = h.cluster_size
+        self.l2_entries = h.cluster_size // 8
+        self.refblock_entries = h.cluster_size * 8 >> h.refcount_order
+        self.csize_shift = 62 - (h.cluster_bits - 8)
+        self.csize_mask = (1 << (h.cluster_bits - 8)) - 1
+        self.cluster_offset_mask = (1 << self.csize_shift) - 1
+        self.data_file = bool(h.incompatible_features &
+                              QCOW2_INCOMPAT_DATA_FILE)
+
+        self._mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        self.nb_clusters = (len(self._mm) + self.cluster_size - 1) // \
+            self.cluster_size
+        self._l1 = None
+        self._reftable = None
+        self._l2_cache = OrderedDict()
+        self._refblock_cache = OrderedDict()
+
+    def close(self):
+        self._mm.close()
+
+    def _read(self, offset, length):
+        if offset + length > len(self._mm):
+            raise ValueError('%d bytes at %#x are beyond the end of the '
+                             'image file' % (length, offset))
+        return self._mm[offset:offset + length]
+
+    def _table(self, offset, entries):
+        table = array.array('Q', self._read(offset, entries * 8))
+        if sys.byteorder == 'little':
+            table.byteswap()
+        return table
+
+    def _cached(self, cache, offset, load):
+        table = cache.get(offset)
+        if table is None:
+            table = load(offset)
+            cache[offset] = table
+            if len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(offset)
+        return table
+
+    def l1_table(self):
+        if self._l1 is None:
+            self._l1 = self._table(self.header.l1_table_offset,
+                                   self.header.l1_size)
+        return self._l1
+
+    def l2_table(self, offset):
+        return self._cached(self._l2_cache, offset,
+                            lambda o: self._table(o, self.l2_entries))
+
+    def refcount_table(self):
+        if self._reftable is None:
+            self._reftable = self._table(
+                self.header.refcount_table_offset,
+                self.header.refcount_table_clusters * self.l2_entries)
+        return self._reftable
+
+    def _load_refblock(self, offset):
+        buf = self._read(offset, self.cluster_size)
+        bits = 1 << self.header.refcount_order
+        if bits < 8:
+            # sub-byte refcounts start at the least significant bits
+            mask = (1 << bits) - 1
+            return array.array('B', [(byte >> shift) & mask
+                                     for byte in buf
+                                     for shift in range(0, 8, bits)])
+        block = array.array({8: 'B', 16: 'H', 32: 'I', 64: 'Q'}[bits], buf)
+        if sys.byteorder == 'little':
+            block.byteswap()
+        return block
+
+    def refcount_block(self, offset):
+        return self._cached(self._refblock_cache, offset,
+                            self._load_refblock)
+
+    def refcount(self, cluster):
+        """Return the refcount of the given host cluster"""
+        reftable = self.refcount_table()
+        index = cluster // self.refblock_entries
+        if index >= len(reftable) or not reftable[index] & REFT_OFFSET_MASK:
+            return 0
+        block = self.refcount_block(reftable[index] & REFT_OFFSET_MASK)
+        return block[cluster % self.refblock_entries]
+
+    def l2_entry(self, offset):
+        """Return the L2 entry for the guest cluster at offset, or 0"""
+        cluster = offset // self.cluster_size
+        l1 = self.l1_table()
+        l2_offset = l1[cluster // self.l2_entries] & L1E_OFFSET_MASK
+        if not l2_offset:
+            return 0
+        return self.l2_table(l2_offset)[cluster % self.l2_entries]
+
+    def snapshots(self):
+        h = self.header
+        snapshots = []
+        offset = h.snapshot_offset
+        for _ in range(h.nb_snapshots):
+            sn = QcowSnapshot(self._mm, offset)
+            snapshots.append(sn)
+            offset = sn.end
+        return snapshots
+
+    def _extension(self, magic):
+        for ex in self.header.extensions:
+            if ex.magic == magic:
+                return ex.data[:ex.length]
+        return None
+
+    def bitmaps(self):
+        data = self._extension(QCOW2_EXT_MAGIC_BITMAPS)
+        if data is None:
+            return []
+        nb_bitmaps, _, dir_size, dir_offset = struct.unpack('>IIQQ', data)
+        directory = self._read(dir_offset, dir_size)
+        bitmaps = []
+        offset = 0
+        for _ in range(nb_bitmaps):
+            bm = QcowBitmap(directory, offset)
+            bitmaps.append(bm)
+            offset = bm.end
+        return bitmaps
+
+    def _runs(self, table):
+        """
+        Split an L2 table into runs of entries, yielding (index, count,
+        entry) for the first entry of each run.  Entries in a run either
+        point to consecutive host clusters with the same flags, or are
+        all equal and carry no offset.  Compressed entries are runs of
+        their own, so that each of them counts as a reference.
+        """
+        cs = self.cluster_size
+        n = len(table)
+        first = table[0]
+
+        def contiguous(entry):
+            return entry & L2E_OFFSET_MASK and \
+                not entry & QCOW_OFLAG_COMPRESSED
+
+        def no_offset(entry):
+            return not entry & (L2E_OFFSET_MASK | QCOW_OFLAG_COMPRESSED)
+
+        def successor(entry):
+            # the entry that continues the run of entry, None for
+            # compressed entries
+            if contiguous(entry):
+                return entry + cs
+            return entry if no_offset(entry) else None
+
+        # Common cases first: a table that is one run can be recognised
+        # by comparing it as a whole
+        if contiguous(first):
+            if first + (n - 1) * cs < 1 << 64 and \
+                    table == array.array('Q', range(first, first + n * cs,
+                                                    cs)):
+                yield (0, n, first)
+                return
+        elif no_offset(first) and table.count(first) == n:
+            yield (0, n, first)
+            return
+
+        start = 0
+        expected = successor(first)
+        for i in range(1, n):
+            entry = table[i]
+            if entry != expected:
+                yield (start, i - start, table[start])
+                start = i
+            expected = successor(entry)
+        yield (start, n - start, table[start])
+
+    def _compressed_range(self, entry):
+        offset = entry & self.cluster_offset_mask
+        nb_sectors = ((entry >> self.csize_shift) & self.csize_mask) + 1
+        return (offset & ~511, nb_sectors * 512)
+
+    def map(self):
+        """
+        Yield the allocation status of the guest disk as dicts in the
+        format of 'qemu-img map --output=json'.  Clusters not allocated
+        in this image are reported as data=False, and zero=True unless
+        the image has a backing file.
+        """
+        cs = self.cluster_size
+        size = self.header.size
+        unallocated = (False, self.header.backing_file is None, None)
+        current = None
+        start = 0
+        end = 0
+
+        def extent(start, end, data, zero, offset):
+            ext = OrderedDict([('start', start), ('length', end - start),
+                               ('depth', 0), ('zero', zero),
+                               ('data', data)])
+            if offset is not None:
+                ext['offset'] = offset
+            return ext
+
+        for l1_index, l1_entry in enumerate(self.l1_table()):
+            base = l1_index * self.l2_entries * cs
+            if base >= size:
+                break
+            l2_offset = l1_entry & L1E_OFFSET_MASK
+            if l2_offset:
+                runs = self._runs(self.l2_table(l2_offset))
+            else:
+                runs = [(0, self.l2_entries, 0)]
+
+            for index, count, entry in runs:
+                run_start = base + index * cs
+                if run_start >= size:
+                    break
+                run_end = min(run_start + count * cs, size)
+                offset = entry & L2E_OFFSET_MASK or None
+                if entry & QCOW_OFLAG_COMPRESSED:
+                    status = (True, False, None)
+                elif entry & QCOW_OFLAG_ZERO and self.header.version >= 3:
+                    status = (False, True, offset)
+                elif offset is not None:
+                    status = (True, False, offset)
+                else:
+                    status = unallocated
+
+                if current is not None and status[:2] == current[:2] and \
+                        (current[2] is None) == (status[2] is None) and \
+                        (status[2] is None or
+                         status[2] == current[2] + end - start):
+                    end = run_end
+                    continue
+                if current is not None:
+                    yield extent(start, end, *current)
+                current, start, end = status, run_start, run_end
+
+        if end < size:
+            if current is not None and current == unallocated:
+                end = size
+            else:
+                if current is not None:
+                    yield extent(start, end, *current)
+                current, start, end = unallocated, end, size
+        if current is not None:
+            yield extent(start, end, *current)
+
+    def check(self):
+        """
+        Count the references to every host cluster from the image metadata
+        and compare them to the refcounts, like 'qemu-img check' does.
+        Returns a QcowCheckResult.
+        """
+        cs = self.cluster_size
+        h = self.header
+        references = array.array('I', bytes(4 * self.nb_clusters))
+        roles = bytearray(self.nb_clusters)
+        result = QcowCheckResult(references)
+
+        def reference(offset, length, role):
+            first = offset // cs
+            end = (offset + length + cs - 1) // cs
+            if end > self.nb_clusters:
+                result.out_of_range.append((offset, ROLES[role]))
+                end = self.nb_clusters
+            n = end - first
+            if n > 1 and roles[first:end] == bytes(n):
+                # nothing else uses these clusters yet
+                roles[first:end] = bytes([role]) * n
+                references[first:end] = array.array('I', [1]) * n
+                return
+            for cluster in range(first, end):
+                if not roles[cluster]:
+                    roles[cluster] = role
+                elif roles[cluster] != role:
+                    result.overlaps.append((cluster, ROLES[roles[cluster]],
+                                            ROLES[role]))
+                references[cluster] += 1
+
+        def reference_l1(offset, l1_size):
+            reference(offset, l1_size * 8, ROLE_L1)
+            try:
+                l1 = self._table(offset, l1_size)
+            except ValueError:
+                return
+            for l1_entry in l1:
+                l2_offset = l1_entry & L1E_OFFSET_MASK
+                if not l2_offset:
+                    continue
+                reference(l2_offset, cs, ROLE_L2)
+                try:
+                    l2 = self.l2_table(l2_offset)
+                except ValueError:
+                    continue
+                for _, count, entry in self._runs(l2):
+                    if entry & QCOW_OFLAG_COMPRESSED:
+                        reference(*self._compressed_range(entry),
+                                  ROLE_COMPRESSED)
+                    elif entry & L2E_OFFSET_MASK and not self.data_file:
+                        reference(entry & L2E_OFFSET_MASK, count * cs,
+                                  ROLE_DATA)
+
+        reference(0, cs, ROLE_HEADER)
+        reference(h.refcount_table_offset, h.refcount_table_clusters * cs,
+                  ROLE_REFTABLE)
+        reftable = self.refcount_table()
+        for entry in reftable:
+            if entry & REFT_OFFSET_MASK:
+                reference(entry & REFT_OFFSET_MASK, cs, ROLE_REFBLOCK)
+
+        reference_l1(h.l1_table_offset, h.l1_size)
+
+        if h.nb_snapshots:
+            snapshots = self.snapshots()
+            reference(h.snapshot_offset, snapshots[-1].end - h.snapshot_offset,
+                      ROLE_SNAPSHOTS)
+            for sn in snapshots:
+                reference_l1(sn.l1_table_offset, sn.l1_size)
+
+        data = self._extension(QCOW2_EXT_MAGIC_BITMAPS)
+        if data is not None:
+            _, _, dir_size, dir_offset = struct.unpack('>IIQQ', data)
+            reference(dir_offset, dir_size, ROLE_BITMAP_DIR)
+            for bm in self.bitmaps():
+                reference(bm.table_offset, bm.table_size * 8,
+                          ROLE_BITMAP_TABLE)
+                for entry in self._table(bm.table_offset, bm.table_size):
+                    if entry & BME_TABLE_ENTRY_OFFSET_MASK:
+                        reference(entry & BME_TABLE_ENTRY_OFFSET_MASK, cs,
+                                  ROLE_BITMAP_DATA)
+
+        data = self._extension(QCOW2_EXT_MAGIC_CRYPTO_HEADER)
+        if data is not None:
+            offset, length = struct.unpack('>QQ', data)
+            reference(offset, length, ROLE_CRYPTO)
+
+        # Compare whole refcount blocks at a time, and only look at the
+        # individual clusters of those that differ
+        for index in range(max(len(reftable), (self.nb_clusters - 1) //
+                               self.refblock_entries + 1)):
+            first = index * self.refblock_entries
+            expected = references[first:first + self.refblock_entries]
+            if index < len(reftable) and reftable[index] & REFT_OFFSET_MASK:
+                refcounts = self.refcount_block(reftable[index] &
+                                                REFT_OFFSET_MASK)
+            elif not any(expected):
+                continue
+            else:
+                refcounts = array.array('I', bytes(4 * len(expected)))
+            if expected == refcounts[:len(expected)] and \
+                    not any(refcounts[len(expected):]):
+                continue
+            for i, refcount in enumerate(refcounts):
+                ref = expected[i] if i < len(expected) else 0
+                if refcount > ref:
+                    result.leaks.append((first + i, refcount, ref))
+                elif refcount < ref:
+                    result.corruptions.append((first + i, refcount, ref))
+
+        return result
+
+def cmd_dump_map(fd):
+    img = QcowImage(fd)
+    print('[' + ',\n'.join(json.dumps(ext) for ext in img.map()) + ']')
+    img.close()
+
+def cmd_check(fd):
+    img = QcowImage(fd)
+    res = img.check()
+    img.close()
+
+    for cluster, refcount, ref in res.corruptions:
+        print("ERROR cluster %d refcount=%d reference=%d" %
+              (cluster, refcount, ref))
+    for cluster, role, other in res.overlaps:
+        print("ERROR cluster %d is used as both %s and %s" %
+              (cluster, role, other))
+    for offset, role in res.out_of_range:
+        print("ERROR %s at %#x is beyond the end of the image file" %
+              (role, offset))
+    for cluster, refcount, ref in res.leaks:
+        print("Leaked cluster %d refcount=%d reference=%d" %
+              (cluster, refcount, ref))
+
+    if res.errors() or res.leaks:
+        print("")
+    if res.errors():
+        print("%d errors were found on the image." % res.errors())
+    if res.leaks:
+        print("%d leaked clusters were found on the image." %
+              len(res.leaks))
+    if not res.errors() and not res.leaks:
+        print("No errors were found on the image.")
+
 def cmd_dump_header(fd):
     h = QcowHeader(fd)
     h.dump()
@@ -249,10 +731,15 @@ cmds = [
     [ 'add-header-ext-stdio', cmd_add_header_ext_stdio, 1, 'Add a header extension, data from stdin' ],
     [ 'del-header-ext',       cmd_del_header_ext,       1, 'Delete a header extension' ],
     [ 'set-feature-bit',      cmd_set_feature_bit,      2, 'Set a feature bit'],
+    [ 'dump-map',             cmd_dump_map,             0, 'Dump the allocation map like qemu-img map'],
+    [ 'check',                cmd_check,                0, 'Check refcounts like qemu-img check'],
 ]
 
+# Commands that do not modify the image
+read_only_cmds = ['dump-header', 'dump-header-exts', 'dump-map', 'check']
+
 def main(filename, cmd, args):
-    fd = open(filename, "r+b")
+    fd = open(filename, "rb" if cmd in read_only_cmds else "r+b")
     try:
         for name, handler, num_args, desc in cmds:
             if name != cmd: